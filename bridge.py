@@ -0,0 +1,395 @@
+import os, json, struct, time, select, socket, zlib
+
+import numpy as np
+
+import procon
+
+# Streams procon segments between machines. The sender tails local segments
+# and sends every new frame; the receiver republishes them into local
+# segments of the same name. Every message starts with:
+#    0  magic     2s   b'PB'
+#    2  version   u8
+#    3  kind      u8   HELLO or FRAME
+#    4  session   u32  random per sender run; a new one resets the receiver
+#    8  stream    u16  index into the sender's stream list
+#   10  flags     u16  KEY, DELTA, ZLIB for frames
+#   12  seq       u64  per-stream frame counter of the sender
+#   20  frag      u16  fragment index (UDP splits frames to fit the MTU)
+#   22  frags     u16  number of fragments
+# HELLO carries the stream description as JSON and is repeated periodically
+# so receivers can join at any time; FRAME carries the encoded payload. Over
+# TCP each message is preceded by its u32 length and never fragmented.
+#
+# Frames are encoded as raw bytes, float16, or 8-bit dB (published on the
+# far side as float32 decibels). With delta compression, frames between
+# keyframes carry the wrapping difference of their codes from the previous
+# frame, deflated; a receiver that missed a frame skips deltas until the
+# next keyframe.
+MAGIC = b'PB'
+VERSION = 1
+PACKET = struct.Struct('<2sBBIHHQHH')
+LENGTH = struct.Struct('<I')
+HELLO, FRAME = 0, 1
+KEY, DELTA, ZLIB = 1, 2, 4
+ENCODINGS = ('raw', 'f16', 'db8')
+DEFAULT_PORT = 47000
+UDP_PAYLOAD = 1400
+
+class Codec(object):
+    # Converts frames of one stream to and from wire codes. Each end keeps
+    # its own instance, since deltas depend on the previous frame.
+    def __init__(self, encoding, dtype, count, scale='linear', floor=-100.0, span=120.0):
+        if encoding not in ENCODINGS:
+            raise ValueError('Unknown encoding: {}'.format(encoding))
+        self.encoding = encoding
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self.scale = scale
+        self.floor = floor
+        self.span = span
+        if encoding == 'raw':
+            self.wire = self.dtype
+        elif encoding == 'f16':
+            self.wire = np.dtype('<f2')
+        else:
+            self.wire = np.dtype('u1')
+        # Deltas are taken on the codes as unsigned integers, so they wrap.
+        self.uint = np.dtype('<u{}'.format(self.wire.itemsize))
+        self.codes = np.zeros(count, dtype=self.wire)
+        self.prev = np.zeros(count, dtype=self.uint)
+        self.has_prev = False
+        self.scratch = np.empty(count, dtype=np.float32)
+
+    def out_meta(self, meta):
+        # The metadata of the republished segment.
+        meta = dict(meta)
+        if self.encoding == 'db8':
+            meta.update(dtype='<f4', scale='db', floor=self.floor)
+        return meta
+
+    def quantize(self, frame):
+        frame = frame.reshape(-1)
+        if self.encoding == 'raw':
+            self.codes[:] = frame
+        elif self.encoding == 'f16':
+            np.copyto(self.codes, frame, casting='unsafe')
+        else:
+            db = self.scratch
+            if self.scale == 'db':
+                db[:] = frame
+            else:
+                np.maximum(frame, 10 ** (self.floor / 20), out=db)
+                np.log10(db, out=db)
+                db *= 20
+            db -= self.floor
+            db *= 255 / self.span
+            np.clip(db, 0, 255, out=db)
+            np.rint(db, out=db)
+            self.codes[:] = db
+        return self.codes
+
+    def dequantize(self, codes, out):
+        out = out.reshape(-1)
+        if self.encoding == 'db8':
+            np.multiply(codes, self.span / 255, out=out, casting='unsafe')
+            out += self.floor
+        else:
+            np.copyto(out, codes, casting='unsafe')
+
+    def encode(self, frame, key, delta=True, compress=True):
+        codes = self.quantize(frame).view(self.uint)
+        flags = KEY if key or not delta or not self.has_prev else 0
+        if flags & KEY:
+            payload = codes
+        else:
+            payload = codes - self.prev
+            flags |= DELTA
+        self.prev[:] = codes
+        self.has_prev = True
+        payload = payload.tobytes()
+        if compress:
+            packed = zlib.compress(payload, 1)
+            if len(packed) < len(payload):
+                payload, flags = packed, flags | ZLIB
+        return flags, payload
+
+    def decodable(self, flags):
+        # False for a delta against a frame this end never saw.
+        return not flags & DELTA or self.has_prev
+
+    def decode(self, flags, payload, out):
+        if flags & ZLIB:
+            payload = zlib.decompress(payload)
+        codes = np.frombuffer(payload, dtype=self.uint)
+        if flags & DELTA:
+            codes = codes + self.prev
+        self.prev[:] = codes
+        self.has_prev = True
+        self.dequantize(codes.view(self.wire), out)
+
+def parse_target(spec, default_host=''):
+    host, _, port = spec.rpartition(':')
+    return (host or default_host, int(port) if port else DEFAULT_PORT)
+
+class Sender(object):
+    # Tails the named segments and sends their frames to every destination.
+    # names may carry a per-stream encoding, as in "fft:db8".
+    def __init__(self, names, dests, base=procon.DEFAULT_BASE, proto='udp', encoding='raw',
+                 delta=False, keyframe_interval=30, hello_interval=1.0, db_span=120.0, payload=UDP_PAYLOAD):
+        self.proto = proto
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.hello_interval = hello_interval
+        self.payload = payload
+        self.session = struct.unpack('<I', os.urandom(4))[0]
+        self.segments, self.codecs, self.frames, self.hellos = [], [], [], []
+        for index, spec in enumerate(names):
+            name, _, enc = spec.partition(':')
+            seg = procon.attach(name, base)
+            count = seg.size // seg.dtype.itemsize
+            codec = Codec(enc or encoding, seg.dtype, count, seg.meta.get('scale', 'linear'), seg.meta.get('floor', -100.0), db_span)
+            desc = {'name': name, 'size': seg.size, 'encoding': codec.encoding, 'meta': seg.meta,
+                    'floor': codec.floor, 'span': codec.span, 'scale': codec.scale}
+            self.segments.append(seg)
+            self.codecs.append(codec)
+            self.frames.append(np.empty(seg.shape, dtype=seg.dtype))
+            self.hellos.append(json.dumps(desc).encode('utf8'))
+        self.seqs = [0] * len(self.segments)
+        self.last_seqs = [None] * len(self.segments)
+        if proto == 'udp':
+            self.socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]
+            self.dests = list(dests)
+        elif proto == 'tcp':
+            self.socks = [socket.create_connection(dest) for dest in dests]
+            for sock in self.socks:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.dests = None
+        else:
+            raise ValueError('Unknown protocol: {}'.format(proto))
+        self.last_hello = None
+        self.sent = 0
+        self.bytes = 0
+        self.raw_bytes = 0
+
+    def _packet(self, kind, stream, flags, seq, data, frag=0, frags=1):
+        return PACKET.pack(MAGIC, VERSION, kind, self.session, stream, flags, seq, frag, frags) + data
+
+    def _send(self, kind, stream, flags, seq, data):
+        if self.proto == 'tcp':
+            msg = self._packet(kind, stream, flags, seq, data)
+            for sock in self.socks:
+                sock.sendall(LENGTH.pack(len(msg)) + msg)
+            self.bytes += len(msg) * len(self.socks)
+            return
+        frags = max(1, -(-len(data) // self.payload))
+        for frag in range(frags):
+            msg = self._packet(kind, stream, flags, seq, data[frag * self.payload:(frag + 1) * self.payload], frag, frags)
+            for dest in self.dests:
+                self.socks[0].sendto(msg, dest)
+            self.bytes += len(msg) * len(self.dests)
+
+    def hello(self):
+        for index, hello in enumerate(self.hellos):
+            self._send(HELLO, index, 0, 0, hello)
+        self.last_hello = time.monotonic()
+
+    def poll(self, timeout=None):
+        # Sends the frames published since the last poll, waiting up to
+        # timeout for at least one. Returns the number sent.
+        if self.last_hello is None or (self.proto == 'udp' and time.monotonic() - self.last_hello >= self.hello_interval):
+            self.hello()
+        if not any(seg.changed(last) for seg, last in zip(self.segments, self.last_seqs)):
+            select.select([seg.fileno() for seg in self.segments], [], [], timeout)
+        sent = 0
+        for index, seg in enumerate(self.segments):
+            seg.wait_for_frame(0, self.last_seqs[index])
+            if not seg.changed(self.last_seqs[index]):
+                continue
+            self.last_seqs[index] = seg.snapshot(self.frames[index])
+            seq = self.seqs[index]
+            key = self.keyframe_interval <= 0 or seq % self.keyframe_interval == 0
+            flags, data = self.codecs[index].encode(self.frames[index], key, self.delta)
+            self._send(FRAME, index, flags, seq, data)
+            self.seqs[index] += 1
+            self.raw_bytes += seg.size
+            sent += 1
+        self.sent += sent
+        return sent
+
+    def close(self):
+        for seg in self.segments:
+            seg.close()
+        for sock in self.socks:
+            sock.close()
+
+class Stream(object):
+    # Receiver-side state of one sender stream.
+    def __init__(self, desc, base, prefix):
+        meta = desc['meta']
+        dtype = np.dtype(meta.get('dtype', 'uint8'))
+        count = desc['size'] // dtype.itemsize
+        self.codec = Codec(desc['encoding'], dtype, count, desc['scale'], desc['floor'], desc['span'])
+        out_meta = self.codec.out_meta(meta)
+        self.seg = procon.Segment(prefix + desc['name'], base, count * np.dtype(out_meta['dtype']).itemsize, out_meta)
+        self.view = self.seg.writable_view
+        self.last = None
+        self.pending = None
+        self.fragments = {}
+
+    def close(self):
+        self.seg.close()
+
+class Receiver(object):
+    # Listens on bind and republishes incoming streams under base. Counts
+    # frames received, dropped (gaps in seq), late (older than the newest)
+    # and undecodable (deltas after a drop).
+    def __init__(self, bind, base=procon.DEFAULT_BASE, proto='udp', prefix=''):
+        self.base = base
+        self.proto = proto
+        self.prefix = prefix
+        if proto == 'udp':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+        elif proto == 'tcp':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            raise ValueError('Unknown protocol: {}'.format(proto))
+        self.sock.bind(bind)
+        if proto == 'tcp':
+            self.sock.listen()
+        self.address = self.sock.getsockname()
+        self.conns = {}
+        self.streams = {}
+        self.names = {}
+        self.received = self.dropped = self.late = self.undecodable = 0
+        self.bytes = 0
+
+    def _handle(self, msg):
+        if len(msg) < PACKET.size:
+            return
+        magic, version, kind, session, stream, flags, seq, frag, frags = PACKET.unpack_from(msg)
+        if magic != MAGIC or version != VERSION:
+            return
+        data = msg[PACKET.size:]
+        key = (session, stream)
+        if kind == HELLO:
+            if key not in self.streams:
+                # A stream we have not seen, or a restarted sender taking
+                # over a name: (re)create its segment.
+                desc = json.loads(data.decode('utf8'))
+                old = self.names.get(desc['name'])
+                if old in self.streams:
+                    self.streams.pop(old).close()
+                self.names[desc['name']] = key
+                self.streams[key] = Stream(desc, self.base, self.prefix)
+            return
+        st = self.streams.get(key)
+        if st is None:
+            return
+        if frags > 1:
+            if st.pending != seq:
+                st.pending, st.fragments = seq, {}
+            st.fragments[frag] = data
+            if len(st.fragments) < frags:
+                return
+            data = b''.join(st.fragments[i] for i in range(frags))
+            st.pending, st.fragments = None, {}
+        if st.last is not None:
+            if seq <= st.last:
+                self.late += 1
+                return
+            if seq > st.last + 1:
+                self.dropped += seq - st.last - 1
+                st.codec.has_prev = False
+        st.last = seq
+        if not st.codec.decodable(flags):
+            self.undecodable += 1
+            return
+        with st.seg.writing():
+            st.codec.decode(flags, data, st.view)
+        self.received += 1
+
+    def _read_tcp(self, conn):
+        buf = self.conns[conn]
+        chunk = conn.recv(1 << 16)
+        if not chunk:
+            del self.conns[conn]
+            conn.close()
+            return
+        self.bytes += len(chunk)
+        buf += chunk
+        while len(buf) >= LENGTH.size:
+            length, = LENGTH.unpack_from(buf)
+            if len(buf) < LENGTH.size + length:
+                break
+            self._handle(bytes(buf[LENGTH.size:LENGTH.size + length]))
+            del buf[:LENGTH.size + length]
+
+    def poll(self, timeout=None):
+        readable, _, _ = select.select([self.sock] + list(self.conns), [], [], timeout)
+        for sock in readable:
+            if self.proto == 'udp':
+                while True:
+                    try:
+                        msg = sock.recv(1 << 16)
+                    except BlockingIOError:
+                        break
+                    self.bytes += len(msg)
+                    self._handle(msg)
+            elif sock is self.sock:
+                conn, _ = sock.accept()
+                self.conns[conn] = bytearray()
+            else:
+                self._read_tcp(sock)
+        return len(readable)
+
+    def close(self):
+        for st in self.streams.values():
+            st.close()
+        for conn in self.conns:
+            conn.close()
+        self.sock.close()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Bridge procon segments over the network.')
+    parser.add_argument('-B', '--base', dest='base', default=procon.DEFAULT_BASE, help='Base path for data files')
+    parser.add_argument('-p', '--proto', dest='proto', choices=('udp', 'tcp'), default='udp', help='Transport protocol')
+    parser.add_argument('--status-interval', dest='status_interval', type=float, default=1.0, help='Seconds between status lines (0 disables)')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    p = sub.add_parser('send', help='Send local segments to receivers')
+    p.add_argument('names', nargs='+', help='Segments to send, optionally with an encoding, e.g. fft:db8')
+    p.add_argument('-t', '--to', dest='dests', action='append', required=True, help='Receiver HOST[:PORT]; may be repeated')
+    p.add_argument('-e', '--encoding', dest='encoding', choices=ENCODINGS, default='raw', help='Default frame encoding')
+    p.add_argument('--delta', dest='delta', action='store_true', help='Send deflated deltas between keyframes')
+    p.add_argument('--keyframe-interval', dest='keyframe_interval', type=int, default=30, help='Frames between keyframes with --delta')
+    p.add_argument('--db-span', dest='db_span', type=float, default=120.0, help='Decibel range above the floor covered by db8')
+    p = sub.add_parser('recv', help='Receive segments and republish them locally')
+    p.add_argument('bind', nargs='?', default=':{}'.format(DEFAULT_PORT), help='Local [HOST]:PORT to listen on')
+    p.add_argument('--prefix', dest='prefix', default='', help='Prefix for the republished segment names')
+    args = parser.parse_args()
+
+    if args.command == 'send':
+        end = Sender(args.names, [parse_target(dest, 'localhost') for dest in args.dests], args.base, args.proto,
+                     args.encoding, args.delta, args.keyframe_interval, db_span=args.db_span)
+        status = lambda: 'Sent {} frames, {} bytes ({:.2f}x)'.format(end.sent, end.bytes, end.raw_bytes / max(end.bytes, 1))
+    else:
+        end = Receiver(parse_target(args.bind), args.base, args.proto, args.prefix)
+        status = lambda: 'Received {} frames, {} bytes; dropped {}, late {}, undecodable {}'.format(
+            end.received, end.bytes, end.dropped, end.late, end.undecodable)
+    last = time.monotonic()
+    try:
+        while True:
+            end.poll(0.5)
+            now = time.monotonic()
+            if args.status_interval > 0 and now - last >= args.status_interval:
+                print('\r\x1b[K' + status(), end='', flush=True)
+                last = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('\r\x1b[K' + status())
+        end.close()
@@ -0,0 +1,343 @@
+import time
+
+import numpy as np
+
+class RingBuffer(object):
+    # Every sample is stored twice, size apart, so that the most recent
+    # `size` samples are always one contiguous view (see latest()).
+    def __init__(self, size, dtype=np.float32):
+        self.size = size
+        self.buf = np.zeros((2 * size,), dtype=dtype)
+        self.pos = 0
+
+    def write(self, frames):
+        if len(frames) > self.size:
+            frames = frames[-self.size:]
+        n = len(frames)
+        first = min(n, self.size - self.pos)
+        rest = n - first
+        self.buf[self.pos:self.pos + first] = frames[:first]
+        self.buf[self.pos + self.size:self.pos + self.size + first] = frames[:first]
+        if rest:
+            self.buf[:rest] = frames[first:]
+            self.buf[self.size:self.size + rest] = frames[first:]
+        self.pos = (self.pos + n) % self.size
+
+    def latest(self, n=None):
+        if n is None:
+            n = self.size
+        end = self.pos + self.size
+        return self.buf[end - n:end]
+
+    def hops(self, window, hop, count):
+        # The last `count` windows, `hop` samples apart, as one strided view
+        # of shape (count, window); needs size >= window + (count - 1) * hop.
+        base = self.latest(window + (count - 1) * hop)
+        stride = base.strides[0]
+        return np.lib.stride_tricks.as_strided(
+            base, shape=(count, window), strides=(hop * stride, stride), writeable=False,
+        )
+
+class Analyzer(object):
+    # Windowed magnitude spectra for up to max_batch hops at once, computed
+    # with a single 2-D rfft into preallocated arrays.
+    def __init__(self, window, hop, window_func='blackman', max_batch=1):
+        self.window = window
+        self.hop = hop
+        self.bins = window // 2 + 1
+        self.max_batch = max_batch
+        self.winf = getattr(np, window_func)(window).astype(np.float32)
+        self.scratch = np.empty((max_batch, window), dtype=np.float32)
+        self.mags = np.empty((max_batch, self.bins), dtype=np.float32)
+        self.scale = np.float32(1.0 / hop)
+        self.timer = None
+
+    @property
+    def history(self):
+        return self.window + (self.max_batch - 1) * self.hop
+
+    def process(self, ring, count=1):
+        scratch, mags = self.scratch[:count], self.mags[:count]
+        t0 = time.perf_counter()
+        np.multiply(ring.hops(self.window, self.hop, count), self.winf, out=scratch)
+        t1 = time.perf_counter()
+        np.abs(np.fft.rfft(scratch, axis=-1), out=mags, casting='same_kind')
+        mags *= self.scale
+        if self.timer is not None:
+            self.timer('window', t1 - t0)
+            self.timer('fft', time.perf_counter() - t1)
+        return mags
+
+def to_db(mags, out, floor=-100.0):
+    # 20 * log10(mags), clamped below at floor; out may alias mags.
+    np.maximum(mags, 10.0 ** (floor / 20.0), out=out)
+    np.log10(out, out=out)
+    out *= 20
+    np.maximum(out, floor, out=out)
+    return out
+
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+def mel(f):
+    return 2595.0 * np.log10(1.0 + f / 700.0)
+
+def inv_mel(m):
+    return 700.0 * (10.0 ** (m / 2595.0) - 1.0)
+
+def band_weights(scale, bands, window, rate, fmin=20.0, fmax=None):
+    # (bands, bins) matrix mapping rfft magnitudes onto perceptual bands. Each
+    # row sums to 1, so a band is a weighted average of the bins under it.
+    if fmax is None:
+        fmax = rate / 2.0
+    freqs = np.fft.rfftfreq(window, 1.0 / rate)
+    if scale == 'mel':
+        edges = inv_mel(np.linspace(mel(fmin), mel(fmax), bands + 2))
+    elif scale in ('log', 'cq'):
+        edges = np.geomspace(fmin, fmax, bands + 2)
+    else:
+        raise ValueError('Unknown band scale: {}'.format(scale))
+    lo, center, hi = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    if scale == 'cq':
+        # Constant-Q: a Hann window of width center / Q around each center,
+        # with Q chosen from the band spacing.
+        q = 1.0 / (edges[1] / edges[0] - 1.0)
+        width = center / q
+        rel = (freqs - center) / width
+        weights = np.where(np.abs(rel) < 0.5, np.cos(np.pi * rel) ** 2, 0.0)
+    else:
+        weights = np.maximum(0, np.minimum((freqs - lo) / (center - lo), (hi - freqs) / (hi - center)))
+    # Bands narrower than a bin catch no bin centers; interpolate instead.
+    empty = weights.sum(axis=1) == 0
+    if empty.any():
+        pos = np.clip(center[empty, 0] * window / rate, 0, len(freqs) - 1)
+        low = np.floor(pos).astype(int)
+        high = np.minimum(low + 1, len(freqs) - 1)
+        rows = np.nonzero(empty)[0]
+        weights[rows, low] += 1 - (pos - low)
+        weights[rows, high] += pos - low
+    weights /= weights.sum(axis=1, keepdims=True)
+    return weights.astype(np.float32), center[:, 0]
+
+class Binner(object):
+    # Applies a precomputed band weight matrix once per hop; sparse when SciPy
+    # is available and the matrix is mostly zeros, dense otherwise.
+    def __init__(self, scale, bands, window, rate, fmin=20.0, fmax=None):
+        self.weights, self.centers = band_weights(scale, bands, window, rate, fmin, fmax)
+        self.sparse = None
+        if scipy is not None and np.count_nonzero(self.weights) < 0.1 * self.weights.size:
+            self.sparse = scipy.sparse.csr_matrix(self.weights)
+
+    def apply(self, mags, out):
+        if self.sparse is not None:
+            out[:] = self.sparse.dot(mags)
+        else:
+            np.dot(self.weights, mags, out=out)
+        return out
+
+def time_coef(dt, tau):
+    # Per-step coefficient of a one-pole filter with time constant tau.
+    if tau <= 0:
+        return 1.0
+    return 1.0 - np.exp(-dt / tau)
+
+class Smoother(object):
+    # Attack/release smoothing, peak-hold with timed decay and a running
+    # min/max for auto-ranging, all in place on preallocated arrays. out is a
+    # (3, bins) array receiving the smoothed, peak and normalized spectra;
+    # range_out receives the running [min, max].
+    def __init__(self, bins, dt, attack=0.01, release=0.2, hold=0.5, peak_release=0.5, range_release=5.0, out=None, range_out=None):
+        self.dt = np.float32(dt)
+        self.attack = np.float32(time_coef(dt, attack))
+        self.release = np.float32(time_coef(dt, release))
+        self.hold = np.float32(hold)
+        self.peak_release = np.float32(time_coef(dt, peak_release))
+        self.range_release = time_coef(dt, range_release)
+        self.out = np.zeros((3, bins), dtype=np.float32) if out is None else out
+        self.range = np.zeros((2,), dtype=np.float32) if range_out is None else range_out
+        self.smooth, self.peak, self.norm = self.out
+        self.timer = np.zeros((bins,), dtype=np.float32)
+        self.diff = np.empty((bins,), dtype=np.float32)
+        self.coef = np.empty((bins,), dtype=np.float32)
+        self.mask = np.empty((bins,), dtype=bool)
+        self.primed = False
+
+    def update(self, values):
+        if not self.primed:
+            self.smooth[:] = values
+            self.peak[:] = values
+            self.range[:] = values.min(), values.max()
+            self.primed = True
+        diff, coef, mask = self.diff, self.coef, self.mask
+
+        np.subtract(values, self.smooth, out=diff)
+        np.greater(diff, 0, out=mask)
+        np.multiply(mask, self.attack - self.release, out=coef)
+        coef += self.release
+        diff *= coef
+        self.smooth += diff
+
+        self.timer -= self.dt
+        np.subtract(values, self.peak, out=diff)
+        np.greater_equal(diff, 0, out=mask)
+        np.copyto(self.timer, self.hold, where=mask)
+        np.copyto(self.peak, values, where=mask)
+        np.less_equal(self.timer, 0, out=mask)
+        diff *= self.peak_release
+        np.add(self.peak, diff, out=self.peak, where=mask)
+
+        lo, hi = self.smooth.min(), self.smooth.max()
+        self.range[0] = lo if lo < self.range[0] else self.range[0] + (lo - self.range[0]) * self.range_release
+        self.range[1] = hi if hi > self.range[1] else self.range[1] + (hi - self.range[1]) * self.range_release
+        span = max(self.range[1] - self.range[0], 1e-12)
+        np.subtract(self.smooth, self.range[0], out=self.norm)
+        self.norm /= span
+        np.clip(self.norm, 0, 1, out=self.norm)
+        return self.out
+
+class SlidingDFT(object):
+    # Incremental DFT of a few selected bins: each hop costs one (bins x hop)
+    # matrix-vector product against a twiddle matrix of that size, instead of
+    # a full rfft. That only wins while bins * hop stays well below
+    # window * log2(window); over all bins it is slower than an rfft unless
+    # the hop is tiny. Only the requested bins (plus neighbours needed for
+    # windowing) are tracked.
+    # The window is applied in the frequency domain, so only cosine-sum
+    # windows are supported; they are the periodic forms, which differ
+    # slightly from NumPy's symmetric ones. The recursive state is resynced
+    # with an exact FFT every `resync` hops to stop rounding drift.
+    KERNELS = {
+        'rect': (1.0,),
+        'hanning': (0.5, 0.5),
+        'hamming': (0.54, 0.46),
+        'blackman': (0.42, 0.5, 0.08),
+    }
+
+    def __init__(self, window, hop, window_func='blackman', max_batch=1, bins=None, resync=256):
+        if window_func not in self.KERNELS:
+            raise ValueError('Sliding DFT supports only {} windows'.format(', '.join(sorted(self.KERNELS))))
+        self.window = window
+        self.hop = hop
+        self.max_batch = max_batch
+        self.resync = resync
+        self.selected = np.arange(window // 2 + 1) if bins is None else np.asarray(bins, dtype=int)
+        self.bins = len(self.selected)
+
+        coefs = self.KERNELS[window_func]
+        offsets = np.arange(1 - len(coefs), len(coefs))
+        taps = np.array([coefs[abs(o)] if o == 0 else (-1) ** abs(o) * coefs[abs(o)] / 2 for o in offsets])
+        wanted = (self.selected[:, None] + offsets[None, :]) % window
+        self.needed, inverse = np.unique(wanted, return_inverse=True)
+        self.taps = taps.astype(np.complex128)
+        self.tap_index = inverse.reshape(wanted.shape)
+
+        theta = 2 * np.pi * self.needed / window
+        self.rotate = np.exp(1j * hop * theta)
+        self.twiddle = np.exp(1j * np.outer(theta, np.arange(hop, 0, -1)))
+        self.state = np.zeros((len(self.needed),), dtype=np.complex128)
+        self.diff = np.empty((hop,), dtype=np.float64)
+        self.mags = np.empty((max_batch, self.bins), dtype=np.float32)
+        self.scale = np.float32(1.0 / hop)
+        self.count = 0
+        self.timer = None
+
+    @property
+    def history(self):
+        return self.window + self.max_batch * self.hop
+
+    def process(self, ring, count=1):
+        window, hop = self.window, self.hop
+        base = ring.latest(window + count * hop)
+        mags = self.mags[:count]
+        windowing = 0.0
+        t0 = time.perf_counter()
+        for i in range(count):
+            np.subtract(base[window + i * hop:window + (i + 1) * hop], base[i * hop:(i + 1) * hop], out=self.diff)
+            self.state *= self.rotate
+            self.state += self.twiddle.dot(self.diff)
+            self.count += 1
+            if self.resync and self.count % self.resync == 0:
+                self.state[:] = np.fft.fft(base[(i + 1) * hop:window + (i + 1) * hop])[self.needed]
+            t1 = time.perf_counter()
+            np.abs(self.state[self.tap_index].dot(self.taps), out=mags[i], casting='same_kind')
+            windowing += time.perf_counter() - t1
+        mags *= self.scale
+        if self.timer is not None:
+            self.timer('window', windowing)
+            self.timer('fft', time.perf_counter() - t0 - windowing)
+        return mags
+
+class Features(object):
+    # Compact per-hop features from linear magnitudes: spectral flux, an
+    # onset flag against an adaptive mean + k * std threshold, a tempo
+    # estimate from the autocorrelation of recent flux, and energy in a few
+    # log-spaced bands. out receives [flux, onset, threshold, bpm, energy...].
+    FIELDS = ['flux', 'onset', 'threshold', 'bpm']
+
+    def __init__(self, bins, dt, bands=8, sensitivity=1.5, threshold_window=0.5, tempo_window=6.0, min_gap=0.1, bpm_range=(60, 200), out=None):
+        self.dt = dt
+        self.sensitivity = sensitivity
+        self.size = len(self.FIELDS) + bands
+        self.out = np.zeros((self.size,), dtype=np.float32) if out is None else out
+        self.energy = self.out[len(self.FIELDS):]
+        self.starts = np.unique(np.geomspace(1, bins + 1, bands + 1).astype(int)[:-1] - 1)
+        self.band_energy = np.zeros((len(self.starts),), dtype=np.float32)
+        self.logmag = np.zeros((bins,), dtype=np.float32)
+        self.prev = np.zeros((bins,), dtype=np.float32)
+        self.scratch = np.empty((bins,), dtype=np.float32)
+        self.tempo_hops = max(int(tempo_window / dt), 4)
+        self.threshold_hops = max(int(threshold_window / dt), 2)
+        # Both the onset threshold and tempo read from the same flux history.
+        self.flux = RingBuffer(max(self.tempo_hops, self.threshold_hops))
+        self.min_gap = max(int(min_gap / dt), 1)
+        self.lags = np.arange(max(int(60.0 / (bpm_range[1] * dt)), 1), int(60.0 / (bpm_range[0] * dt)) + 1)
+        self.tempo_every = max(int(0.5 / dt), 1)
+        self.since_onset = self.min_gap
+        self.count = 0
+
+    def update(self, mags):
+        np.log1p(mags, out=self.logmag)
+        np.subtract(self.logmag, self.prev, out=self.scratch)
+        np.maximum(self.scratch, 0, out=self.scratch)
+        flux = self.scratch.mean()
+        self.prev[:] = self.logmag
+
+        recent = self.flux.latest(self.threshold_hops)
+        threshold = recent.mean() + self.sensitivity * recent.std()
+        self.since_onset += 1
+        onset = flux > threshold and self.since_onset >= self.min_gap
+        if onset:
+            self.since_onset = 0
+        self.flux.write(np.array([flux], dtype=np.float32))
+
+        self.count += 1
+        if self.count % self.tempo_every == 0:
+            self.out[3] = self.tempo()
+
+        np.multiply(mags, mags, out=self.scratch)
+        np.add.reduceat(self.scratch, self.starts, out=self.band_energy)
+        self.energy[:len(self.band_energy)] = self.band_energy
+        self.out[:3] = flux, onset, threshold
+        return self.out
+
+    def update_batch(self, rows):
+        # Several hops published as one frame: the onset flag is set if any
+        # of them had an onset, not just the last.
+        onset = False
+        for row in rows:
+            onset |= bool(self.update(row)[1])
+        self.out[1] = onset
+        return self.out
+
+    def tempo(self):
+        hist = self.flux.latest(self.tempo_hops)
+        hist = hist - hist.mean()
+        n = len(hist)
+        spec = np.fft.rfft(hist, 2 * n)
+        acf = np.fft.irfft(spec * spec.conj())[:n]
+        lags = self.lags[self.lags < n]
+        if not len(lags) or acf[0] <= 0:
+            return 0.0
+        return 60.0 / (lags[np.argmax(acf[lags])] * self.dt)
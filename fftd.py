@@ -1,41 +1,276 @@
-import argparse
+import argparse, time, concurrent.futures
 
 import numpy as np
-import pyaudio
 
-import procon
+import procon, dsp, sources, stats
 
 parser = argparse.ArgumentParser(description='Provide Fast Fourier Transform data.')
 parser.add_argument('-B', '--base', dest='base', default=procon.DEFAULT_BASE, help='Base path for data files')
 parser.add_argument('-n', '--name', dest='name', default='fft', help='Name of the spectrum data file')
 parser.add_argument('--win-name', dest='win_name', default='win', help='Name of the signal data file')
-parser.add_argument('-W', '--window', dest='window', type=int, default=1024, help='Number of samples in FFT window')
+parser.add_argument('-W', '--window', dest='windows', type=int, nargs='+', default=[1024], help='Number of samples in FFT window; several sizes may be given')
 parser.add_argument('-f', '--frames', dest='frames', type=int, default=512, help='Number of frames to read per FFT calculation')
-parser.add_argument('-r', '--rate', dest='rate', type=int, default=44100, help='Sample rate of the audio stream')
+parser.add_argument('-r', '--rate', dest='rate', type=int, default=44100, help='Sample rate of the audio stream (WAV files provide their own)')
+parser.add_argument('-c', '--channels', dest='channels', type=int, default=1, help='Number of input channels to analyze')
+parser.add_argument('--name-format', dest='name_format', default='{name}.{channel}.{window}', help='Format of data file names when analyzing several channels or window sizes')
+parser.add_argument('--workers', dest='workers', type=int, default=1, help='Number of threads computing FFTs in parallel')
 parser.add_argument('--window-func', dest='window_func', default='blackman', help='Window function in use (see numpy window functions)')
+parser.add_argument('--sdft', dest='sdft', action='store_true', help='Update spectra incrementally with a sliding DFT instead of a full FFT per hop')
+parser.add_argument('--sdft-bins', dest='sdft_bins', help='Only compute these bins in sliding DFT mode, e.g. "0:64,100,128:512:4"')
+parser.add_argument('--sdft-resync', dest='sdft_resync', type=int, default=256, help='Hops between exact FFT resyncs of the sliding DFT state (0 never resyncs)')
+parser.add_argument('--bands', dest='bands', type=int, default=0, help='Also publish this many perceptual bands to <name>.bands (0 disables)')
+parser.add_argument('--band-scale', dest='band_scale', choices=('log', 'mel', 'cq'), default='log', help='Frequency scale of the published bands')
+parser.add_argument('--fmin', dest='fmin', type=float, default=20.0, help='Lowest band center frequency')
+parser.add_argument('--fmax', dest='fmax', type=float, help='Highest band center frequency (default Nyquist)')
+parser.add_argument('--db', dest='db', action='store_true', help='Publish magnitudes in decibels instead of linear')
+parser.add_argument('--db-floor', dest='db_floor', type=float, default=-100.0, help='Lowest published decibel value')
+parser.add_argument('--smooth', dest='smooth', action='store_true', help='Also publish smoothed, peak-hold and auto-ranged spectra to <name>.post and <name>.range')
+parser.add_argument('--attack', dest='attack', type=float, default=0.01, help='Smoothing time constant for rising magnitudes, in seconds')
+parser.add_argument('--release', dest='release', type=float, default=0.2, help='Smoothing time constant for falling magnitudes, in seconds')
+parser.add_argument('--peak-hold', dest='peak_hold', type=float, default=0.5, help='Time peaks are held before decaying, in seconds')
+parser.add_argument('--peak-release', dest='peak_release', type=float, default=0.5, help='Time constant of peak decay after the hold, in seconds')
+parser.add_argument('--range-release', dest='range_release', type=float, default=5.0, help='Time constant with which the auto-ranging min/max relax, in seconds')
+parser.add_argument('--features', dest='features', action='store_true', help='Also publish flux, onset, tempo and band energy features to <name>.feat')
+parser.add_argument('--feature-bands', dest='feature_bands', type=int, default=8, help='Number of energy bands in the feature segment')
+parser.add_argument('--onset-sensitivity', dest='onset_sensitivity', type=float, default=1.5, help='Standard deviations above the recent mean flux that count as an onset')
+parser.add_argument('--tempo-window', dest='tempo_window', type=float, default=6.0, help='Seconds of flux history used for tempo estimation')
+parser.add_argument('-s', '--source', dest='source', choices=('pyaudio', 'file', 'synth'), default='pyaudio', help='Where to read audio from')
+parser.add_argument('-i', '--input', dest='input', help='Input path for the file source (.wav, or raw PCM otherwise)')
+parser.add_argument('--raw-format', dest='raw_format', default='float32', help='Sample dtype of raw PCM input files')
+parser.add_argument('--synth', dest='synth', default='sine:440', help='Synth source spec, e.g. "sine:440,chirp:20:20000:5:0.5,noise:0.1"')
+parser.add_argument('--seed', dest='seed', type=int, help='Random seed for synth noise')
+parser.add_argument('--loop', dest='loop', action='store_true', help='Loop the file source at end of file')
+parser.add_argument('--device', dest='device', type=int, help='PyAudio input device index')
+parser.add_argument('--offline', dest='offline', action='store_true', help='Run file or synth sources as fast as possible and report throughput')
+parser.add_argument('--queue-depth', dest='queue_depth', type=int, default=16, help='Number of captured blocks buffered between the capture thread and the FFT')
+parser.add_argument('--max-batch', dest='max_batch', type=int, default=8, help='Maximum number of pending hops computed in one batched FFT when catching up')
+parser.add_argument('--slots', dest='slots', type=int, default=0, help='Frame slots per data file, letting readers grab the latest frame without waiting on the writer (0 disables, otherwise at least 2)')
+parser.add_argument('--adapt', dest='adapt', action='store_true', help='Publish spectra less often, batching hops, while every consumer reads slower than they are published')
+parser.add_argument('--status-interval', dest='status_interval', type=float, default=1.0, help='Seconds between status line updates (0 disables)')
+parser.add_argument('--stats-name', dest='stats_name', help='Also publish pipeline statistics to this data file')
+parser.add_argument('--stats-json', dest='stats_json', help='Also dump pipeline statistics as JSON to this path at every status update')
+parser.add_argument('--hops', dest='hops', type=int, help='Stop after this many FFT calculations')
 args = parser.parse_args()
 
-print('Latency: {}s'.format(args.window / (2 * args.rate)))
-print('Framerate: {}s^-1'.format(args.rate / args.frames))
-size = 4 * (args.window // 2 + 1)
-print('Datafile Size: {}byte'.format(size))
-
-pa = pyaudio.PyAudio()
-st = pa.open(rate=args.rate, channels=1, format=pyaudio.paFloat32, input=True)
-
-buf = np.zeros((args.window,), dtype=np.float32)
-fft_out = procon.get(args.name, args.base, size)
-win_out = procon.get(args.win_name, args.base, 4 * args.window)
-winf = getattr(np, args.window_func)(args.window)
-
-frm = 0
-
-while True:
-    frames = np.frombuffer(st.read(args.frames), dtype=np.float32)
-    buf = np.concatenate((buf, frames))[-args.window:]
-    win_out[:] = buf.tobytes()
-    arr = (np.abs(np.fft.rfft(winf * buf)) / args.frames).astype(np.float32)
-    #print(len(out[:]), len(arr.tobytes()))
-    fft_out[:] = arr.tobytes()
-    frm += 1
-    print('\r                                        \rFrame: {}'.format(frm), end='')
+if args.offline and args.source == 'pyaudio':
+    parser.error('--offline requires a file or synth source')
+if args.sdft_bins and not args.sdft:
+    parser.error('--sdft-bins requires --sdft')
+if args.sdft_bins and args.bands:
+    parser.error('--bands needs every bin and cannot be combined with --sdft-bins')
+if args.bands and args.fmin < 0:
+    parser.error('--fmin cannot be negative')
+if args.bands and args.fmin == 0 and args.band_scale in ('log', 'cq'):
+    parser.error('--fmin must be above 0 for the {} band scale'.format(args.band_scale))
+if args.adapt and args.status_interval <= 0:
+    parser.error('--adapt reads consumer rates at each status update and needs a positive --status-interval')
+if args.slots != 0 and not 2 <= args.slots <= procon.MAX_SLOTS:
+    parser.error('--slots must be 0 or between 2 and {}'.format(procon.MAX_SLOTS))
+
+def parse_bins(spec, window):
+    bins = []
+    for part in spec.split(','):
+        if ':' in part:
+            bins.extend(range(*[int(p) for p in part.split(':')]))
+        else:
+            bins.append(int(part))
+    bins = np.array(bins, dtype=int)
+    if bins.size == 0 or bins.min() < 0 or bins.max() > window // 2:
+        parser.error('--sdft-bins must lie in [0, {}] for window {}'.format(window // 2, window))
+    return bins
+
+if args.sdft:
+    # A sliding DFT hop is a (bins x hop) product against a twiddle matrix of
+    # the same size; past about window*log2(window) an rfft per hop is faster.
+    for window in args.windows:
+        tracked = len(parse_bins(args.sdft_bins, window)) if args.sdft_bins else window // 2 + 1
+        if tracked * args.frames > window * np.log2(window):
+            if not args.sdft_bins:
+                parser.error('--sdft over all {} bins with {}-sample hops is slower than an FFT for window {}; select bins with --sdft-bins or shorten --frames'.format(tracked, args.frames, window))
+            print('Warning: --sdft over {} bins with {}-sample hops is likely slower than an FFT for window {}'.format(tracked, args.frames, window))
+
+src = sources.open_source(
+    args.source, rate=args.rate, channels=args.channels, path=args.input, raw_format=args.raw_format,
+    synth=args.synth, loop=args.loop, seed=args.seed, device=args.device,
+    realtime=not args.offline,
+)
+rate = src.rate
+if src.channels < args.channels:
+    parser.error('Source only has {} channels'.format(src.channels))
+if args.bands:
+    if args.fmax is not None and args.fmax > rate / 2:
+        parser.error('--fmax {} is above the Nyquist frequency {}'.format(args.fmax, rate / 2))
+    if args.fmin >= (rate / 2 if args.fmax is None else args.fmax):
+        parser.error('--fmin must be below --fmax (default Nyquist)')
+
+multi = args.channels > 1 or len(args.windows) > 1
+
+def product_name(name, channel, window):
+    if not multi:
+        return name
+    return args.name_format.format(name=name, channel=channel, window=window)
+
+# Restarting with the same options reuses the existing segments in place, so
+# consumers keep their mappings across producer restarts.
+segments = procon.Registry(args.base)
+stats_seg = None
+if args.stats_name:
+    stats_seg = segments.create(args.stats_name, np.float64, len(stats.Stats.FIELDS), labels=stats.Stats.FIELDS)
+pstats = stats.Stats(args.status_interval, stats_seg, args.stats_json)
+
+magnitude_format = {'scale': 'db', 'floor': args.db_floor} if args.db else {'scale': 'linear'}
+stream_meta = {'rate': rate, 'hop': args.frames, 'channels': args.channels}
+
+class Product(object):
+    def __init__(self, channel, window):
+        self.channel = channel
+        if args.sdft:
+            bins = parse_bins(args.sdft_bins, window) if args.sdft_bins else None
+            self.analyzer = dsp.SlidingDFT(window, args.frames, args.window_func, args.max_batch, bins, args.sdft_resync)
+        else:
+            self.analyzer = dsp.Analyzer(window, args.frames, args.window_func, args.max_batch)
+        self.timer = self.analyzer.timer = pstats.timer()
+        self.name = product_name(args.name, channel, window)
+        bins = self.analyzer.bins
+        meta = dict(stream_meta, channel=channel, window=window, window_func=args.window_func, **magnitude_format)
+        if args.sdft_bins:
+            meta['bins'] = self.analyzer.selected.tolist()
+        self.seg = segments.create(self.name, np.float32, bins, args.slots, **meta)
+        self.view = self.seg.writable_view
+        self.binner = None
+        if args.bands:
+            self.binner = dsp.Binner(args.band_scale, args.bands, window, rate, args.fmin, args.fmax)
+            self.bands_seg = segments.create(
+                self.name + '.bands', np.float32, args.bands, args.slots,
+                band_scale=args.band_scale, centers=self.binner.centers.tolist(), **meta
+            )
+            self.bands_view = self.bands_seg.writable_view
+        self.smoother = None
+        if args.smooth:
+            self.post_seg = segments.create(self.name + '.post', np.float32, (3, bins), args.slots, labels=['smooth', 'peak', 'norm'], **meta)
+            self.range_seg = segments.create(self.name + '.range', np.float32, 2, args.slots, labels=['min', 'max'], **meta)
+            self.smoother = dsp.Smoother(
+                bins, args.frames / rate, args.attack, args.release,
+                args.peak_hold, args.peak_release, args.range_release,
+                self.post_seg.writable_view, self.range_seg.writable_view,
+            )
+        self.features = None
+        if args.features:
+            labels = dsp.Features.FIELDS + ['energy{}'.format(i) for i in range(args.feature_bands)]
+            self.feat_seg = segments.create(
+                self.name + '.feat', np.float32, len(labels), args.slots,
+                labels=labels, **dict(stream_meta, channel=channel, window=window)
+            )
+            self.features = dsp.Features(
+                bins, args.frames / rate, args.feature_bands,
+                args.onset_sensitivity, tempo_window=args.tempo_window,
+                out=self.feat_seg.writable_view,
+            )
+
+    def process(self, count):
+        mags = self.analyzer.process(rings[self.channel], count)
+        t0 = time.perf_counter()
+        if self.binner is not None:
+            with self.bands_seg.writing():
+                self.binner.apply(mags[-1], self.bands_view)
+                if args.db:
+                    dsp.to_db(self.bands_view, self.bands_view, args.db_floor)
+        if self.features is not None:
+            with self.feat_seg.writing():
+                self.features.update_batch(mags)
+        if args.db:
+            dsp.to_db(mags, mags, args.db_floor)
+        with self.seg.writing():
+            self.view[:] = mags[-1]
+        if self.smoother is not None:
+            with self.post_seg.writing(), self.range_seg.writing():
+                for row in mags:
+                    self.smoother.update(row)
+        self.timer('publish', time.perf_counter() - t0)
+
+print('Framerate: {}s^-1'.format(rate / args.frames))
+for window in args.windows:
+    print('Window {}: Latency: {}s, Datafile Size: {}byte'.format(window, window / (2 * rate), 4 * (window // 2 + 1)))
+
+products = [Product(channel, window) for channel in range(args.channels) for window in args.windows]
+history = max(product.analyzer.history for product in products)
+max_window = max(args.windows)
+rings = [dsp.RingBuffer(history) for channel in range(args.channels)]
+win_segs = [
+    segments.create(
+        args.win_name if args.channels == 1 else '{}.{}'.format(args.win_name, channel),
+        np.float32, max_window, args.slots, channel=channel, **stream_meta
+    )
+    for channel in range(args.channels)
+]
+pool = concurrent.futures.ThreadPoolExecutor(args.workers) if args.workers > 1 else None
+
+capture = sources.Capture(src, args.frames, args.queue_depth, timer=pstats.timer())
+capture.start()
+loop_timer = pstats.timer()
+pstats.watch.extend(product.seg for product in products)
+
+batch_min, adapt_probe = 1, 0
+def adapt_batch(snap):
+    # Every consumer reading slower than we publish means frames computed
+    # for nobody: batch enough hops per publish to match the fastest reader.
+    # Once they keep up, probe a smaller batch every few reports.
+    global batch_min, adapt_probe
+    readers = [c for readers in snap['consumers'].values() for c in readers if c['frames']]
+    if not readers:
+        batch_min = 1
+        return
+    fastest = max(c['rate'] for c in readers)
+    if fastest < 0.9 * snap['hops_per_sec'] / batch_min:
+        # Rounded down, so the publish rate never drops below what the
+        # fastest reader takes.
+        batch_min = min(args.max_batch, max(1, int(snap['hops_per_sec'] // max(fastest, 1e-3))))
+        adapt_probe = 0
+    elif batch_min > 1:
+        adapt_probe += 1
+        if adapt_probe >= 5:
+            batch_min, adapt_probe = batch_min - 1, 0
+
+pending = []
+try:
+    while args.hops is None or pstats.hops < args.hops:
+        pending += capture.drain(args.max_batch - len(pending), 0.5)
+        if len(pending) < batch_min and not capture.eof:
+            continue
+        blocks, pending = pending, []
+        if not blocks:
+            if capture.eof:
+                break
+            continue
+        if args.hops is not None:
+            blocks = blocks[:args.hops - pstats.hops]
+        t0 = time.perf_counter()
+        for captured, block in blocks:
+            for channel, ring in enumerate(rings):
+                ring.write(block[:, channel])
+        loop_timer('buffer', time.perf_counter() - t0)
+        if pool is None:
+            for product in products:
+                product.process(len(blocks))
+        else:
+            for fut in [pool.submit(product.process, len(blocks)) for product in products]:
+                fut.result()
+        t0 = time.perf_counter()
+        for ring, win_seg in zip(rings, win_segs):
+            win_seg.publish(ring.latest(max_window))
+        now = time.perf_counter()
+        loop_timer('publish', now - t0)
+        pstats.overflows = capture.overflows + src.overflows
+        pstats.record(len(blocks), [captured for captured, block in blocks], now)
+        if pstats.due(now):
+            snap = pstats.report(now)
+            if args.adapt:
+                adapt_batch(snap)
+finally:
+    if not capture.stop():
+        print('Warning: capture thread did not stop; closing its source anyway')
+    src.close()
+    if pool is not None:
+        pool.shutdown()
+    pstats.report(time.perf_counter(), final=True)
+    segments.close()
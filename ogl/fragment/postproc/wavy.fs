@@ -10,6 +10,7 @@ uniform float uAngle = 0.0;
 uniform float uFreq = 100.0;
 uniform float uSampF = 0.003;
 uniform float uLow = -3.0, uHigh = 0.0;
+uniform bool uDecibels = false;
 uniform float uMaxMag = 0.005, uMinMag = 0.0;
 uniform vec4 uColor = vec4(1.0, 1.0, 1.0, 1.0);
 
@@ -21,8 +22,8 @@ void main(void) {
 	float scsamp = uSampF * bSpectrum.length();
 	int lowidx = clamp(int(floor(scsamp)), 0, bSpectrum.length() - 1);
 	int highidx = clamp(int(ceil(scsamp)), 0, bSpectrum.length() - 1);
-	float lsamp = log(bSpectrum[lowidx]) / log(10);
-	float hsamp = log(bSpectrum[highidx]) / log(10);
+	float lsamp = uDecibels ? bSpectrum[lowidx] / 20.0 : log(bSpectrum[lowidx]) / log(10);
+	float hsamp = uDecibels ? bSpectrum[highidx] / 20.0 : log(bSpectrum[highidx]) / log(10);
 	float normu = mix(lsamp, hsamp, scsamp - floor(scsamp));
 	normu = clamp((normu - uLow) / (uHigh - uLow), 0.0, 1.0);
 	float amp = mix(uMinMag, uMaxMag, normu);
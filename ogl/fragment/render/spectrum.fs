@@ -14,6 +14,7 @@ uniform float uFreqExp=0.5, uHueExp=1.5, uIntensityExp=2.0, uYExp=1.0;
 uniform float uTopVal=0.0, uRange=5.0;
 uniform float uMinClip=-100, uMaxClip=100;
 uniform float uLowEnd=0.03, uHighEnd=0.75;
+uniform bool uDecibels=false;
 
 float unmap_x(float x) {
 	return pow(2.0, pow(x, 1.0/uFreqExp)) - 1.0;
@@ -39,7 +40,7 @@ void main(void) {
 	vec2 zoc = vUV;
 	int sampidx = clamp(int(trunc(unmap_x(mix(uLowEnd, uHighEnd, zoc.x)) * bSpectrum.length())), 0, bSpectrum.length() - 1);
 	float samp = bSpectrum[sampidx];
-	samp = clamp(log(samp)/log(10), uMinClip, uMaxClip);
+	samp = clamp(uDecibels ? samp / 20.0 : log(samp)/log(10), uMinClip, uMaxClip);
 	float crity = pow(clamp((samp / uRange) - uTopVal + 1.0, 0.0, 1.0), uYExp);
 	FragColor = zoc.y > crity ? vec4(0.0, 0.0, 0.0, 0.0) : vec4(hsv2rgb(map_col(zoc.x, crity)), crity);
 	//FragColor = vec4(zoc, 0.0, 1.0);
@@ -10,8 +10,9 @@ import procon
 if not glfw.init():
     exit()
 
-data = procon.get('fft')
-SAMPLES = int(len(data) / 4)
+data = procon.attach('fft')
+decibels = data.meta.get('scale') == 'db'
+SAMPLES = data.shape[-1]
 shader_defines = '#define SAMPLES {}\n'.format(SAMPLES)
 
 glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 4)
@@ -75,6 +76,8 @@ glEnableVertexAttribArray(vPosition)
 glVertexAttribPointer(vPosition, 2, GL_FLOAT, GL_FALSE, 0, None)
 uSpectrum = glGetUniformLocation(prog, "uSpectrum")
 uWinSize = glGetUniformLocation(prog, "uWinSize")
+uDecibels = glGetUniformLocation(prog, "uDecibels")
+glUniform1i(uDecibels, int(decibels))
 
 num_u = glGetProgramiv(prog, GL_ACTIVE_UNIFORMS)
 print('Uniforms:', num_u)
@@ -105,6 +108,9 @@ print(glGetInteger(GL_MAX_VERTEX_ATTRIBS))
 
 #exit()
 
+data_array = np.zeros(data.shape, dtype=data.dtype)
+data_seq = None
+
 while not glfw.window_should_close(win):
 
     glfw.make_context_current(win)
@@ -117,8 +123,19 @@ while not glfw.window_should_close(win):
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
     glUseProgram(prog)
-    data_array = np.frombuffer(data[:], dtype=np.float32)
-    glUniform1fv(uSpectrum, 513, data_array)
+    if data.stale and os.path.exists(data.path):
+        # fftd restarted with other settings; the shader is built for the old
+        # bin count, so only the scale can follow.
+        data = data.reattach()
+        if data.shape[-1] != SAMPLES:
+            raise SystemExit('fft now has {} bins, restart to follow'.format(data.shape[-1]))
+        decibels = data.meta.get('scale') == 'db'
+        glUniform1i(uDecibels, int(decibels))
+        data_array = np.zeros(data.shape, dtype=data.dtype)
+        data_seq = None
+    if data.changed(data_seq):
+        data_seq = data.snapshot(data_array)
+        glUniform1fv(uSpectrum, SAMPLES, data_array)
     glUniform2f(uWinSize, *winsz)
     glBindVertexArray(vao)
     glDrawArrays(GL_TRIANGLE_FAN, 0, 4)
@@ -1,4 +1,4 @@
-import sys, os, ctypes, colorsys, time
+import sys, os, colorsys, time
 sys.path.append(os.path.normpath(os.path.join(os.getcwd(), '..')))
 
 import glfw
@@ -19,14 +19,18 @@ def real_time():
 def scaled_time(f):
     return f * real_time()
 
-data = procon.get('fft')
-sig = procon.get('win')
-DATA_SAMPLES = int(len(data) / 4)
-data_type = ctypes.c_float * DATA_SAMPLES
-data_ptr = data_type.from_buffer(data)
-SIG_SAMPLES = int(len(sig) / 4)
-sig_type = ctypes.c_float * SIG_SAMPLES
-sig_ptr = sig_type.from_buffer(sig)
+data = procon.attach('fft')
+decibels = data.meta.get('scale') == 'db'
+sig = procon.attach('win')
+for seg in (data, sig):
+    if seg.dtype != np.float32:
+        raise ValueError('{} holds {}, but the shaders expect float32'.format(seg.name, seg.dtype))
+DATA_SAMPLES = data.shape[-1]
+data_ptr = np.zeros(data.shape, dtype=data.dtype)
+data_seq = None
+SIG_SAMPLES = sig.shape[-1]
+sig_ptr = np.zeros(sig.shape, dtype=sig.dtype)
+sig_seq = None
 
 glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 4)
 glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
@@ -119,6 +123,9 @@ tex_img.wrap_t = GL_REPEAT
 tex_img.min_filter = GL_NEAREST
 tex_img.mag_filter = GL_NEAREST
 
+for p in (prog, prog_bkgd, prog_img, prog_pproc):
+    p.uniforms.uDecibels.set(int(decibels))
+
 prog.use()
 vao = VertexArrayObject()
 vao[prog.attributes.vPosition].bind(quad)
@@ -187,8 +194,22 @@ while not glfw.window_should_close(win):
         Context.blend_func(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
         Context.enable(GL_BLEND)
 
-        spectrum.update(data_ptr)
-        signal.update(sig_ptr)
+        if data.stale and os.path.exists(data.path):
+            # fftd restarted with other settings; the buffers are sized for
+            # the old layout, so only the scale can follow.
+            data = data.reattach()
+            if data.shape != data_ptr.shape or data.dtype != data_ptr.dtype:
+                raise SystemExit('fft is now {} {}, restart to follow'.format(data.shape, data.dtype))
+            decibels = data.meta.get('scale') == 'db'
+            for p in (prog, prog_bkgd, prog_img, prog_pproc):
+                p.uniforms.uDecibels.set(int(decibels))
+            data_seq = None
+        if data.changed(data_seq):
+            data_seq = data.snapshot(data_ptr)
+            spectrum.update(data_ptr)
+        if sig.changed(sig_seq):
+            sig_seq = sig.snapshot(sig_ptr)
+            signal.update(sig_ptr)
 
         prog_bkgd.use()
         vao_bkgd.draw(GL_TRIANGLES)
@@ -1,18 +1,884 @@
-import mmap, os
+import mmap, os, json, struct, time, contextlib, select, errno, itertools, math, fcntl
+
+import numpy as np
 
 DEFAULT_BASE='/dev/shm/render'
 
+# Every segment file starts with a header, padded to a whole number of pages:
+#    0  magic     4s   b'PRCN'
+#    4  version   u32
+#    8  hdrsize   u32  offset of the payload
+#   12  flags     u32  FLAG_STALE once the file was replaced or unlinked
+#   16  size      u64  payload size in bytes
+#   24  seq       u64  seqlock counter; odd while the producer is writing
+#   32  metalen   u32  length of the metadata
+#   36  slots     u32  number of extra frame slots (0 for a single buffer)
+#   40  latest    u32  index of the most recently completed slot
+#   64  slotseq   u64[MAX_SLOTS]  seq of the frame in each slot; odd while
+#                      it is being filled
+#  128  consumers      MAX_CONSUMERS cursors of CONSUMER, see below
+# 1152  meta           UTF-8 JSON object, up to hdrsize
+# The payload starts on a page boundary, so get() can still hand out a bare
+# mmap of just the data. The metadata describes the payload: at least its
+# dtype and shape, plus whatever the producer adds (rate, window, scale...).
+#
+# With slots, the payload is followed (from the next page) by that many
+# copies of it. The producer still writes the payload in place under the
+# seqlock, and every publish also copies the finished frame into the next
+# slot and points latest at it. Slot readers never wait on the producer;
+# they only retry if their slot was recycled while they copied it, which
+# takes slots - 1 further publishes.
+#
+# Creating a segment that already exists with the same layout and metadata
+# reuses it in place, so a restarted producer does not disturb consumers'
+# live views. Anything else is built in a new file that atomically replaces
+# the old one; consumers still map the old, now stale, file until they
+# reattach().
+#
+# Read-only segments register a cursor in the consumer table the first time
+# they read a frame, and update it on every new frame:
+#    0  pid       u32  owning process, 0 for a free entry
+#    4  token     u32  distinguishes several readers in one process
+#    8  last_seq  u64  seq of the last frame read
+#   16  frames    u64  frames read
+#   24  skipped   u32  frames published but never read
+#   28  rate      f32  smoothed frames read per second
+# so the producer (and `procon.py consumers`) can see who keeps up.
+MAGIC = b'PRCN'
+VERSION = 4
+HEADER = struct.Struct('<4sIIIQ')
+SEQ = struct.Struct('<Q')
+SEQ_OFFSET = 24
+U32 = struct.Struct('<I')
+FLAGS_OFFSET = 12
+FLAG_STALE = 1
+METALEN_OFFSET = 32
+SLOTS_OFFSET = 36
+LATEST_OFFSET = 40
+SLOTSEQ_OFFSET = 64
+MAX_SLOTS = 8
+CONSUMER = struct.Struct('<IIQQIf')
+CONSUMERS_OFFSET = 128
+MAX_CONSUMERS = 32
+RATE_TAU = 1.0
+META_OFFSET = CONSUMERS_OFFSET + MAX_CONSUMERS * CONSUMER.size
+META_SLACK = 1024
+PAGE = mmap.ALLOCATIONGRANULARITY
+
+# Consumers that want to sleep until a frame arrives each create a FIFO in
+# <segment>.notify/; the producer writes a byte to every FIFO there on each
+# publish. A full FIFO already means "new data", so those writes are dropped.
+NOTIFY_SUFFIX = '.notify'
+# The directory's mtime tells the producer when to look for new FIFOs, but
+# coarse timestamps can miss a change; it also rescans at least this often.
+NOTIFY_RESCAN = 0.1
+_notifier_ids = itertools.count()
+
+def _page_align(n):
+    return -(-n // PAGE) * PAGE
+
+def _read_header(fullpath):
+    # (hdrsize, size, slots, meta) of an existing segment file, or None if
+    # there is none or it is not in the current format.
+    try:
+        with open(fullpath, 'rb') as f:
+            magic, version, hdrsize, flags, size = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                return None
+            f.seek(0)
+            header = f.read(hdrsize)
+    except (FileNotFoundError, struct.error):
+        return None
+    metalen, = U32.unpack_from(header, METALEN_OFFSET)
+    slots, = U32.unpack_from(header, SLOTS_OFFSET)
+    return hdrsize, size, slots, json.loads(header[META_OFFSET:META_OFFSET + metalen].decode('utf8') or '{}')
+
+def _mark_stale(fullpath):
+    try:
+        fd = os.open(fullpath, os.O_RDWR)
+    except FileNotFoundError:
+        return
+    try:
+        head = os.pread(fd, HEADER.size, 0)
+        if len(head) == HEADER.size and head[:4] == MAGIC:
+            flags, = U32.unpack_from(head, FLAGS_OFFSET)
+            os.pwrite(fd, U32.pack(flags | FLAG_STALE), FLAGS_OFFSET)
+    finally:
+        os.close(fd)
+
+def _prepare(fullpath, size, meta, slots):
+    # Makes sure fullpath holds a segment of this layout and metadata.
+    # Returns True if an existing file was kept.
+    # A single slot is recycled by the very next publish, so readers could
+    # never finish copying it.
+    if slots != 0 and not 2 <= slots <= MAX_SLOTS:
+        raise ValueError('A segment has either no slots or 2 to {}'.format(MAX_SLOTS))
+    blob = json.dumps(meta).encode('utf8')
+    old = _read_header(fullpath)
+    if old is not None:
+        hdrsize, oldsize, oldslots, oldmeta = old
+        # Consumers read metadata such as scale once, so any change to it
+        # needs a new file they will notice as stale, not just the layout.
+        if (oldsize, oldslots) == (size, slots) and META_OFFSET + len(blob) <= hdrsize and \
+                oldmeta == json.loads(blob.decode('utf8')):
+            return True
+    hdrsize = _page_align(META_OFFSET + len(blob) + META_SLACK)
+    header = bytearray(hdrsize)
+    HEADER.pack_into(header, 0, MAGIC, VERSION, hdrsize, 0, size)
+    U32.pack_into(header, METALEN_OFFSET, len(blob))
+    U32.pack_into(header, SLOTS_OFFSET, slots)
+    header[META_OFFSET:META_OFFSET + len(blob)] = blob
+    tmppath = '{}.{}.tmp'.format(fullpath, os.getpid())
+    fd = os.open(tmppath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, header)
+        # Sparse: the payload pages are only allocated once written.
+        os.ftruncate(fd, hdrsize + _page_align(size) * slots + size)
+    finally:
+        os.close(fd)
+    _mark_stale(fullpath)
+    os.replace(tmppath, fullpath)
+    return False
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _fifo_pid(fifo):
+    # Notification FIFOs are named <pid>.<n>; 0 for anything else.
+    try:
+        return int(fifo.split('.', 1)[0])
+    except ValueError:
+        return 0
+
+def path(name, base=DEFAULT_BASE):
+    return os.path.join(base, name)
+
+class Segment(object):
+    # A shared-memory segment with a seqlock. The producer brackets every
+    # publish with writing() (or begin_write()/end_write()); consumers use
+    # read() or snapshot() for a consistent copy and changed() to check for
+    # new frames. Segments attached read-only map their payload read-only
+    # and, unless track is False, keep a cursor in the consumer table.
+    def __init__(self, name, base=DEFAULT_BASE, size=None, meta=None, writable=True, slots=0, track=None):
+        if not os.path.exists(base):
+            os.makedirs(base)
+        self.name = name
+        self.path = path(name, base)
+        if not os.path.exists(self.path) and size is None:
+            raise ValueError('No file {}; did you start the producer, and is the base correct?'.format(self.path))
+        reused = False
+        if size is not None:
+            if meta is None:
+                meta = {'dtype': 'uint8', 'shape': [size]}
+            reused = _prepare(self.path, size, meta, slots)
+        self.base = base
+        self.header = self.data = self.slot_data = None
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            magic, version, hdrsize, flags, size = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+            if magic != MAGIC:
+                raise ValueError('{} is not a procon segment'.format(self.path))
+            if version != VERSION:
+                raise ValueError('{} has header version {}, expected {}'.format(self.path, version, VERSION))
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            self.header = mmap.mmap(fd, hdrsize)
+            self.data = mmap.mmap(fd, size, access=access, offset=hdrsize)
+            self.slots, = U32.unpack_from(self.header, SLOTS_OFFSET)
+            self.slot_stride = _page_align(size)
+            self.slot_data = None
+            if self.slots:
+                self.slot_data = mmap.mmap(fd, self.slot_stride * (self.slots - 1) + size, access=access, offset=hdrsize + self.slot_stride)
+        finally:
+            os.close(fd)
+        self.size = size
+        self.writable = writable
+        self.retries = 0
+        self.last_seq = None
+        self.notify_dir = self.path + NOTIFY_SUFFIX
+        self._notify_mtime = None
+        self._notify_scan = 0.0
+        self._notify_fds = {}
+        self._fifo = self._fifo_fd = self._fifo_wfd = None
+        self._view = self._writable_view = None
+        self.track = not writable if track is None else track
+        self._cursor = self._cursor_seq = self._cursor_time = None
+        self._frames = self._skipped = 0
+        self._rate = 0.0
+        if reused and self.seq & 1:
+            # The previous producer died mid-publish.
+            self.end_write()
+        self.meta = self._read_meta()
+        self.dtype = np.dtype(self.meta.get('dtype', 'uint8'))
+        self.shape = tuple(self.meta.get('shape', (size // self.dtype.itemsize,)))
+        self._slot_views = [
+            self._readonly(np.frombuffer(self.slot_data, dtype=self.dtype, count=size // self.dtype.itemsize, offset=i * self.slot_stride).reshape(self.shape))
+            for i in range(self.slots)
+        ]
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def stale(self):
+        # True once the producer replaced or unlinked this segment's file.
+        return bool(U32.unpack_from(self.header, FLAGS_OFFSET)[0] & FLAG_STALE)
+
+    def reattach(self):
+        # The replacement is attached first, so if it has gone too this
+        # segment is left open and the caller can try again later.
+        seg = Segment(self.name, self.base, writable=self.writable, track=self.track)
+        self.close()
+        return seg
+
+    def _register(self):
+        # Claims a free (or abandoned) consumer table entry, under a file
+        # lock so that concurrent readers cannot pick the same one.
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            for i in range(MAX_CONSUMERS):
+                offset = CONSUMERS_OFFSET + i * CONSUMER.size
+                pid, = U32.unpack_from(self.header, offset)
+                if pid == 0 or not _alive(pid):
+                    self._token = next(_notifier_ids)
+                    CONSUMER.pack_into(self.header, offset, os.getpid(), self._token, 0, 0, 0, 0.0)
+                    self._cursor = offset
+                    return True
+            return False
+        finally:
+            os.close(fd)
+
+    def _consumed(self, seq):
+        if not self.track or seq == self._cursor_seq:
+            return
+        if self._cursor is None and not self._register():
+            self.track = False
+            return
+        now = time.perf_counter()
+        if self._cursor_seq is not None:
+            self._skipped += max(0, (seq - self._cursor_seq) // 2 - 1)
+            dt = max(now - self._cursor_time, 1e-6)
+            self._rate += (1 - math.exp(-dt / RATE_TAU)) * (1 / dt - self._rate)
+        self._frames += 1
+        self._cursor_seq, self._cursor_time = seq, now
+        CONSUMER.pack_into(self.header, self._cursor, os.getpid(), self._token, seq, self._frames, self._skipped, self._rate)
+
+    def consumers(self):
+        # The registered readers of live processes, with their lag behind the
+        # latest frame, in frames.
+        seq = self.seq & ~1
+        result = []
+        for i in range(MAX_CONSUMERS):
+            pid, token, last_seq, frames, skipped, rate = CONSUMER.unpack_from(self.header, CONSUMERS_OFFSET + i * CONSUMER.size)
+            if pid == 0 or not _alive(pid):
+                continue
+            result.append({
+                'pid': pid, 'token': token, 'last_seq': last_seq, 'lag': max(0, (seq - last_seq) // 2) if frames else None,
+                'frames': frames, 'skipped': skipped, 'rate': rate,
+            })
+        return result
+
+    def _read_meta(self):
+        while True:
+            seq = self.seq
+            if seq & 1:
+                time.sleep(0)
+                continue
+            metalen, = U32.unpack_from(self.header, METALEN_OFFSET)
+            blob = self.header[META_OFFSET:META_OFFSET + metalen]
+            if self.seq == seq:
+                return json.loads(blob.decode('utf8')) if metalen else {}
+
+    def _write_meta(self, meta):
+        blob = json.dumps(meta).encode('utf8')
+        if META_OFFSET + len(blob) > len(self.header):
+            raise ValueError('Metadata for {} does not fit in its header'.format(self.path))
+        with self.writing():
+            self.header[META_OFFSET:META_OFFSET + len(blob)] = blob
+            U32.pack_into(self.header, METALEN_OFFSET, len(blob))
+        self.meta = meta
+
+    def put_meta(self, **meta):
+        # Merges into the existing metadata; the layout cannot change.
+        merged = dict(self.meta, **meta)
+        for key in ('dtype', 'shape', 'fields'):
+            if key in self.meta:
+                merged[key] = self.meta[key]
+        self._write_meta(merged)
+
+    @property
+    def view(self):
+        # A persistent read-only view of the live payload with the recorded
+        # dtype and shape. It is not protected by the seqlock; use snapshot()
+        # when a consistent frame matters.
+        if self._view is None:
+            self._view = self._readonly(np.frombuffer(self.data, dtype=self.dtype).reshape(self.shape))
+        return self._view
+
+    @staticmethod
+    def _readonly(arr):
+        arr.flags.writeable = False
+        return arr
+
+    @property
+    def writable_view(self):
+        # The producer's view for computing in place; wrap writes in writing().
+        if not self.writable:
+            raise ValueError('{} is attached read-only'.format(self.path))
+        if self._writable_view is None:
+            self._writable_view = np.frombuffer(self.data, dtype=self.dtype).reshape(self.shape)
+        return self._writable_view
+
+    @property
+    def seq(self):
+        return SEQ.unpack_from(self.header, SEQ_OFFSET)[0]
+
+    def _set_seq(self, seq):
+        SEQ.pack_into(self.header, SEQ_OFFSET, seq)
+
+    def begin_write(self):
+        self._set_seq(self.seq | 1)
+
+    def end_write(self):
+        seq = self.seq + 1
+        if self.slots:
+            slot = (U32.unpack_from(self.header, LATEST_OFFSET)[0] + 1) % self.slots
+            SEQ.pack_into(self.header, SLOTSEQ_OFFSET + 8 * slot, seq - 1)
+            start = slot * self.slot_stride
+            self.slot_data[start:start + self.size] = self.data
+            SEQ.pack_into(self.header, SLOTSEQ_OFFSET + 8 * slot, seq)
+            U32.pack_into(self.header, LATEST_OFFSET, slot)
+        self._set_seq(seq)
+        self._notify()
+
+    def _notify(self):
+        try:
+            mtime = os.stat(self.notify_dir).st_mtime_ns
+        except FileNotFoundError:
+            return
+        now = time.monotonic()
+        if mtime != self._notify_mtime or now - self._notify_scan >= NOTIFY_RESCAN:
+            self._notify_mtime, self._notify_scan = mtime, now
+            # Dotted names are FIFOs still being set up by fileno().
+            fifos = {fifo for fifo in os.listdir(self.notify_dir) if not fifo.startswith('.')}
+            for fifo in set(self._notify_fds) - fifos:
+                os.close(self._notify_fds.pop(fifo))
+            for fifo in fifos - set(self._notify_fds):
+                try:
+                    self._notify_fds[fifo] = os.open(os.path.join(self.notify_dir, fifo), os.O_WRONLY | os.O_NONBLOCK)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        # No reader: either the consumer died, or it is
+                        # closing and about to unlink the FIFO itself.
+                        pid = _fifo_pid(fifo)
+                        if pid == 0 or not _alive(pid):
+                            self._drop_fifo(fifo, None)
+                    elif e.errno != errno.ENOENT:
+                        raise
+        for fifo, fd in list(self._notify_fds.items()):
+            try:
+                os.write(fd, b'\0')
+            except BlockingIOError:
+                pass
+            except BrokenPipeError:
+                self._drop_fifo(fifo, fd)
+
+    def _drop_fifo(self, fifo, fd):
+        # The consumer went away without cleaning up.
+        if fd is not None:
+            os.close(self._notify_fds.pop(fifo))
+        try:
+            os.unlink(os.path.join(self.notify_dir, fifo))
+        except FileNotFoundError:
+            pass
+
+    def fileno(self):
+        # A descriptor that becomes readable when the producer publishes; pass
+        # it to select/poll, then call wait_for_frame(0) to drain it.
+        if self._fifo_fd is None:
+            os.makedirs(self.notify_dir, exist_ok=True)
+            name = '{}.{}'.format(os.getpid(), next(_notifier_ids))
+            # Made under a dotted name producers ignore, and renamed into
+            # place only once open, so a producer never finds it unread.
+            tmp = os.path.join(self.notify_dir, '.' + name)
+            os.mkfifo(tmp)
+            self._fifo_fd = os.open(tmp, os.O_RDONLY | os.O_NONBLOCK)
+            # Holding a write end too keeps the FIFO from reporting EOF.
+            self._fifo_wfd = os.open(tmp, os.O_WRONLY | os.O_NONBLOCK)
+            self._fifo = os.path.join(self.notify_dir, name)
+            os.rename(tmp, self._fifo)
+        return self._fifo_fd
+
+    def wait_for_frame(self, timeout=None, since=None):
+        # Sleeps until a frame newer than since (by default, the last one this
+        # segment read or waited for) is published. Returns False on timeout.
+        fd = self.fileno()
+        if since is None:
+            since = self.last_seq
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                while os.read(fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            if self.changed(since):
+                self.last_seq = self.seq
+                return True
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            select.select([fd], [], [], remaining)
+
+    def close(self):
+        if self._cursor is not None and self.header is not None:
+            CONSUMER.pack_into(self.header, self._cursor, 0, 0, 0, 0, 0, 0.0)
+            self._cursor = None
+        for fd in self._notify_fds.values():
+            os.close(fd)
+        self._notify_fds = {}
+        if self._fifo_fd is not None:
+            try:
+                os.unlink(self._fifo)
+            except FileNotFoundError:
+                pass
+            os.close(self._fifo_fd)
+            os.close(self._fifo_wfd)
+            self._fifo = self._fifo_fd = self._fifo_wfd = None
+        self._view = self._writable_view = None
+        self._slot_views = []
+        for buf in (self.data, self.slot_data, self.header):
+            if buf is not None:
+                try:
+                    buf.close()
+                except BufferError:
+                    # Someone still holds a view; the mapping goes with it.
+                    pass
+        self.header = self.data = self.slot_data = None
+
+    @contextlib.contextmanager
+    def writing(self):
+        self.begin_write()
+        try:
+            yield self.data
+        finally:
+            self.end_write()
+
+    def publish(self, data):
+        with self.writing():
+            self.data[:] = data
+
+    def changed(self, since):
+        # seq 0 means nothing has been published yet.
+        seq = self.seq
+        return seq != 0 and seq != since and not seq & 1
+
+    def _latest_slot(self):
+        slot, = U32.unpack_from(self.header, LATEST_OFFSET)
+        return slot, SEQ.unpack_from(self.header, SLOTSEQ_OFFSET + 8 * slot)[0]
+
+    def _copy(self, copy):
+        # Runs copy(source) until it saw a consistent frame; source is a slot
+        # index, or None for the seqlocked payload. Returns the frame's seq.
+        while True:
+            if self.slots:
+                slot, seq = self._latest_slot()
+            else:
+                slot, seq = None, self.seq
+            if not seq & 1:
+                copy(slot)
+                if (SEQ.unpack_from(self.header, SLOTSEQ_OFFSET + 8 * slot)[0] if self.slots else self.seq) == seq:
+                    self.last_seq = seq
+                    self._consumed(seq)
+                    return seq
+            self.retries += 1
+            time.sleep(0)
+
+    def read(self, out=None):
+        # Returns (seq, data) with data a consistent copy of the payload, as
+        # bytes or copied into the writable buffer out.
+        result = []
+        if out is not None:
+            dst = memoryview(out).cast('B')
+        def copy(slot):
+            src = self.data if slot is None else self.slot_data[slot * self.slot_stride:slot * self.slot_stride + self.size]
+            if out is None:
+                result[:] = [src[:]]
+            else:
+                dst[:] = src
+                result[:] = [out]
+        seq = self._copy(copy)
+        return seq, result[0]
+
+    def _field_view(self, buf, field):
+        for spec in self.meta.get('fields', ()):
+            if spec['name'] == field:
+                dtype = np.dtype(spec['dtype'])
+                return np.frombuffer(buf, dtype=dtype, count=int(np.prod(spec['shape'])), offset=spec['offset']).reshape(spec['shape'])
+        raise KeyError('{} has no field {!r}'.format(self.path, field))
+
+    def field(self, name, writable=False):
+        # A persistent view of one named array of a packed segment; like view,
+        # it is not protected by the seqlock.
+        if writable:
+            if not self.writable:
+                raise ValueError('{} is attached read-only'.format(self.path))
+            return self._field_view(self.data, name)
+        return self._readonly(self._field_view(self.data, name))
+
+    def snapshot(self, out, field=None):
+        # Copies a consistent frame (or just one field of a packed segment)
+        # into the preallocated array out and returns its sequence number.
+        if field is None:
+            return self._copy(lambda slot: np.copyto(out, self.view if slot is None else self._slot_views[slot]))
+        srcs = [self.field(field)] + [
+            self._field_view(self.slot_data[i * self.slot_stride:i * self.slot_stride + self.size], field)
+            for i in range(self.slots)
+        ]
+        return self._copy(lambda slot: np.copyto(out, srcs[0 if slot is None else slot + 1]))
+
+def create(name, base=DEFAULT_BASE, dtype='float32', shape=None, slots=0, **meta):
+    dtype = np.dtype(dtype)
+    shape = [int(n) for n in np.atleast_1d(shape)]
+    meta.update(dtype=dtype.str, shape=shape)
+    return Segment(name, base, dtype.itemsize * int(np.prod(shape)), meta, slots=slots)
+
+FIELD_ALIGN = 64
+
+def create_packed(name, base=DEFAULT_BASE, fields=(), slots=0, **meta):
+    # One segment holding several named arrays, each cache-line aligned, so a
+    # related set of products shares a mapping and a seqlock. fields is a
+    # sequence (or dict) of name: (dtype, shape); read them with field().
+    specs, offset = [], 0
+    for fname, (dtype, shape) in (fields.items() if isinstance(fields, dict) else fields):
+        dtype = np.dtype(dtype)
+        shape = [int(n) for n in np.atleast_1d(shape)]
+        offset = -(-offset // FIELD_ALIGN) * FIELD_ALIGN
+        specs.append({'name': fname, 'dtype': dtype.str, 'shape': shape, 'offset': offset})
+        offset += dtype.itemsize * int(np.prod(shape))
+    meta.update(dtype='|u1', shape=[offset], fields=specs)
+    return Segment(name, base, offset, meta, slots=slots)
+
+def attach(name, base=DEFAULT_BASE, writable=False, track=None):
+    return Segment(name, base, writable=writable, track=track)
+
+def resize(name, base=DEFAULT_BASE, shape=None, dtype=None):
+    # Recreates an existing (unpacked) segment with a new shape, keeping its
+    # slots and metadata. Consumers see the old one go stale.
+    old = attach(name, base)
+    meta = dict(old.meta)
+    meta.pop('fields', None)
+    dtype = meta.pop('dtype') if dtype is None else dtype
+    meta.pop('shape', None)
+    slots = old.slots
+    old.close()
+    return create(name, base, dtype, shape, slots, **meta)
+
+def unlink(name, base=DEFAULT_BASE):
+    fullpath = path(name, base)
+    _mark_stale(fullpath)
+    try:
+        os.unlink(fullpath)
+    except FileNotFoundError:
+        pass
+    try:
+        os.rmdir(fullpath + NOTIFY_SUFFIX)
+    except OSError:
+        # Absent, or consumers are still waiting on it.
+        pass
+
+class Registry(object):
+    # Tracks the segments a producer owns under one base, so they can be
+    # created, resized and closed together:
+    #     with procon.Registry(base) as reg:
+    #         seg = reg.create('fft', np.float32, bins)
+    # Closing leaves the files in place (consumers keep the last frame and a
+    # restarted producer reuses them) unless unlink is set.
+    def __init__(self, base=DEFAULT_BASE, unlink=False):
+        self.base = base
+        self.unlink_on_close = unlink
+        self.segments = {}
+
+    def _add(self, name, seg):
+        if name in self.segments:
+            self.segments[name].close()
+        self.segments[name] = seg
+        return seg
+
+    def create(self, name, dtype='float32', shape=None, slots=0, **meta):
+        return self._add(name, create(name, self.base, dtype, shape, slots, **meta))
+
+    def create_packed(self, name, fields=(), slots=0, **meta):
+        return self._add(name, create_packed(name, self.base, fields, slots, **meta))
+
+    def attach(self, name, writable=False, track=None):
+        return self._add(name, attach(name, self.base, writable, track))
+
+    def resize(self, name, shape, dtype=None):
+        if name in self.segments:
+            self.segments.pop(name).close()
+        return self._add(name, resize(name, self.base, shape, dtype))
+
+    def unlink(self, name):
+        if name in self.segments:
+            self.segments.pop(name).close()
+        unlink(name, self.base)
+
+    def __getitem__(self, name):
+        return self.segments[name]
+
+    def __contains__(self, name):
+        return name in self.segments
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def close(self):
+        for name in list(self.segments):
+            if self.unlink_on_close:
+                self.unlink(name)
+            else:
+                self.segments.pop(name).close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 def get(name, base=DEFAULT_BASE, size=None):
-    if not os.path.exists(base):
-        os.makedirs(base)
-    fullpath = os.path.join(base, name)
-    if not os.path.exists(fullpath) and size is None:
-        raise ValueError('No file {}; did you start the producer, and is the base correct?'.format(fullpath))
-    elif size is not None:
-        f = open(fullpath, 'wb')
-        f.write(b'\0' * size)
-        f.close()
-    fd = os.open(fullpath, os.O_RDWR)
-    if size is None:
-        size = 0
-    return mmap.mmap(fd, size)
+    return Segment(name, base, size).data
+
+def put_meta(name, base=DEFAULT_BASE, **meta):
+    with Segment(name, base) as seg:
+        seg.put_meta(**meta)
+
+def get_meta(name, base=DEFAULT_BASE):
+    try:
+        with Segment(name, base, writable=False, track=False) as seg:
+            return seg.meta
+    except ValueError:
+        return {}
+
+class Frame(object):
+    # A frame yielded by subscribe(). skipped counts the frames published
+    # since the previous one that were coalesced away. data is read-only and
+    # reused: a snapshot buffer is overwritten on the next iteration, and a
+    # zero-copy slot view once the producer recycles the slot, which valid()
+    # checks. Use copy() to keep a frame.
+    __slots__ = ('segment', 'seq', 'data', 'skipped', 'slot')
+
+    def __init__(self, segment, seq, data, skipped, slot=None):
+        self.segment = segment
+        self.seq = seq
+        self.data = data
+        self.skipped = skipped
+        self.slot = slot
+
+    def valid(self):
+        if self.slot is None:
+            return True
+        return SEQ.unpack_from(self.segment.header, SLOTSEQ_OFFSET + 8 * self.slot)[0] == self.seq
+
+    def copy(self):
+        return self.data.copy()
+
+def _skipped(seq, since):
+    return 0 if since is None else max(0, (seq - since) // 2 - 1)
+
+def _new_frames(seg, since, backlog, buf):
+    # The frames to hand out after since: a snapshot of the newest into buf
+    # (or a new array if buf is None), or with buf False, views of the slots
+    # (all unread ones if backlog, else the newest).
+    if buf is not False:
+        if buf is None:
+            data = np.empty(seg.shape, dtype=seg.dtype)
+            seq = seg.snapshot(data)
+        else:
+            seq = seg.snapshot(buf)
+            data = seg._readonly(buf.view())
+        return [Frame(seg, seq, data, _skipped(seq, since))]
+    pending = sorted(
+        (SEQ.unpack_from(seg.header, SLOTSEQ_OFFSET + 8 * slot)[0], slot)
+        for slot in range(seg.slots)
+    )
+    pending = [(seq, slot) for seq, slot in pending if not seq & 1 and seq and (since is None or seq > since)]
+    if not backlog:
+        pending = pending[-1:]
+    frames = []
+    for seq, slot in pending:
+        frames.append(Frame(seg, seq, seg._slot_views[slot], _skipped(seq, since), slot))
+        since = seq
+    return frames
+
+async def subscribe(name, base=DEFAULT_BASE, interval=0.0, backlog=False, copy=False):
+    # Yields Frames of a segment (a name, or an attached Segment) as they are
+    # published, waiting on its notification FIFO through the running event
+    # loop rather than polling:
+    #     async for frame in procon.subscribe('fft'):
+    #         ...
+    # A slow consumer gets the newest frame, with older ones coalesced; with
+    # interval, frames come at most that often. Slotted segments yield
+    # zero-copy slot views, and with backlog also the unread frames still in
+    # older slots. Otherwise frames are snapshots into a reused buffer, or
+    # fresh arrays if copy is set.
+    import asyncio
+    seg = name if isinstance(name, Segment) else attach(name, base)
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    fd = seg.fileno()
+
+    async def wait():
+        # The reader is only registered while waiting: it is level-triggered,
+        # so left in place while the consumer is busy with a frame, it would
+        # fire on every loop iteration until the FIFO is drained.
+        loop.add_reader(fd, ready.set)
+        try:
+            await ready.wait()
+        finally:
+            loop.remove_reader(fd)
+
+    if copy:
+        buf = None
+    elif seg.slots:
+        buf = False
+    else:
+        buf = np.empty(seg.shape, dtype=seg.dtype)
+    since = last_time = None
+    try:
+        while True:
+            ready.clear()
+            try:
+                while os.read(fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            if not seg.changed(since):
+                await wait()
+                continue
+            if interval and last_time is not None:
+                delay = last_time + interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+            yielded = False
+            for frame in _new_frames(seg, since, backlog, buf):
+                if frame.slot is not None:
+                    if not frame.valid():
+                        continue
+                    seg.last_seq = frame.seq
+                    seg._consumed(frame.seq)
+                since = frame.seq
+                yielded = True
+                yield frame
+            if not yielded:
+                # Every slot was overwritten under us; wait for the next
+                # publish instead of spinning.
+                await wait()
+                continue
+            last_time = loop.time()
+    finally:
+        loop.remove_reader(fd)
+        if seg is not name:
+            seg.close()
+
+def segments(base=DEFAULT_BASE):
+    # Names of the segment files under base.
+    names = []
+    for name in sorted(os.listdir(base)):
+        full = path(name, base)
+        if name.endswith('.tmp') or not os.path.isfile(full):
+            continue
+        with open(full, 'rb') as f:
+            if f.read(4) == MAGIC:
+                names.append(name)
+    return names
+
+def _bench_writer(name, base, rate, stop):
+    seg = attach(name, base, writable=True)
+    view = seg.writable_view
+    frame = 0
+    while not stop.is_set():
+        with seg.writing():
+            view[:] = frame
+        frame += 1
+        if rate:
+            time.sleep(1.0 / rate)
+
+def bench(base=DEFAULT_BASE, size=4096, slots=3, seconds=2.0, rate=0):
+    # Measures consumer snapshot() latency and retries against a producer
+    # process publishing as fast as it can (or at rate), for the single
+    # buffer layout and for the given number of slots.
+    import multiprocessing
+    results = {}
+    for nslots in (0, slots):
+        name = 'bench.{}'.format(os.getpid())
+        seg = create(name, base, np.float32, size // 4, slots=nslots)
+        stop = multiprocessing.Event()
+        proc = multiprocessing.Process(target=_bench_writer, args=(name, base, rate, stop))
+        proc.start()
+        try:
+            reader = attach(name, base)
+            out = np.empty(reader.shape, dtype=reader.dtype)
+            times = []
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                t0 = time.perf_counter()
+                reader.snapshot(out)
+                times.append(time.perf_counter() - t0)
+        finally:
+            stop.set()
+            proc.join()
+            reader.close()
+            seg.close()
+            unlink(name, base)
+        times = np.array(times) * 1e6
+        results[nslots] = {
+            'reads': len(times), 'retries': reader.retries,
+            'mean_us': times.mean(), 'p99_us': np.percentile(times, 99), 'max_us': times.max(),
+        }
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Inspect and exercise procon segments.')
+    parser.add_argument('-B', '--base', dest='base', default=DEFAULT_BASE, help='Base path for data files')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    p = sub.add_parser('bench', help='Compare reader stalls with and without frame slots')
+    p.add_argument('--size', dest='size', type=int, default=4096, help='Frame size in bytes')
+    p.add_argument('--slots', dest='slots', type=int, default=3, help='Number of slots to compare against a single buffer')
+    p.add_argument('--seconds', dest='seconds', type=float, default=2.0, help='Duration of each run')
+    p.add_argument('--rate', dest='rate', type=float, default=0, help='Producer publish rate (0 is as fast as possible)')
+    p = sub.add_parser('consumers', help='Show the readers of segments and how far behind they are')
+    p.add_argument('names', nargs='*', help='Segments to show (default all under the base)')
+    args = parser.parse_args()
+
+    if args.command == 'consumers':
+        for name in args.names or segments(args.base):
+            try:
+                seg = Segment(name, args.base, track=False)
+            except ValueError as e:
+                print('{}: {}'.format(name, e))
+                continue
+            readers = seg.consumers()
+            print('{}: seq {}, {} consumer{}'.format(name, seg.seq, len(readers), '' if len(readers) == 1 else 's'))
+            for c in readers:
+                print('  pid {pid}.{token}: lag {lag}, {frames} frames, {skipped} skipped, {rate:.1f}/s'.format(**c))
+            seg.close()
+    elif args.command == 'bench':
+        for nslots, res in bench(args.base, args.size, args.slots, args.seconds, args.rate).items():
+            print('{} slots: {reads} reads, {retries} retries, mean {mean_us:.2f}us, p99 {p99_us:.2f}us, max {max_us:.1f}us'.format(nslots, **res))
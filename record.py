@@ -0,0 +1,248 @@
+import mmap, os, json, struct, time, select
+
+import numpy as np
+
+import procon
+
+# A capture file holds timestamped frames of any number of procon segments:
+#    0  magic     4s   b'PRCR'
+#    4  version   u32
+#    8  hdrsize   u32  offset of the first record
+#   12  metalen   u32  length of the stream list
+#   16  count     u64  number of complete records
+#   24  end       u64  offset just past the last complete record
+#   32  streams        UTF-8 JSON list of {name, size, slots, meta}, up to hdrsize
+# followed by records, each 8-byte aligned:
+#    0  time      f64  seconds since the start of the capture
+#    8  seq       u64  the segment's seq for this frame
+#   16  stream    u32  index into the stream list
+#   20  size      u32  payload bytes that follow
+# The recorder grows the file in chunks through a mapping and updates count
+# and end after each record, so a capture that was cut short still replays up
+# to its last complete frame.
+MAGIC = b'PRCR'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQQ')
+RECORD = struct.Struct('<dQII')
+STREAMS_OFFSET = 32
+CHUNK = 16 << 20
+
+def _align(n, to=8):
+    return -(-n // to) * to
+
+class Recorder(object):
+    # Tails the named segments and appends every new frame to path. Frames
+    # are copied straight from the segment into the capture mapping.
+    def __init__(self, path, names, base=procon.DEFAULT_BASE, chunk=CHUNK):
+        self.path = path
+        self.chunk = chunk
+        self.segments = [procon.attach(name, base) for name in names]
+        streams = [
+            {'name': name, 'size': seg.size, 'slots': seg.slots, 'meta': seg.meta}
+            for name, seg in zip(names, self.segments)
+        ]
+        blob = json.dumps(streams).encode('utf8')
+        self.hdrsize = _align(STREAMS_OFFSET + len(blob), procon.PAGE)
+        self.file = open(path, 'w+b')
+        self.mapped = 0
+        self.map = None
+        self.metalen = len(blob)
+        self._grow(self.hdrsize)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.hdrsize, self.metalen, 0, self.hdrsize)
+        self.map[STREAMS_OFFSET:STREAMS_OFFSET + len(blob)] = blob
+        self.count = 0
+        self.end = self.hdrsize
+        self.start = None
+        self.last_seqs = [None] * len(self.segments)
+
+    def _grow(self, needed):
+        if needed <= self.mapped:
+            return
+        if self.map is not None:
+            self.map.close()
+        self.mapped = _align(needed, self.chunk)
+        os.ftruncate(self.file.fileno(), self.mapped)
+        self.map = mmap.mmap(self.file.fileno(), self.mapped)
+
+    def _append(self, index, seg, now):
+        size = seg.size
+        total = _align(RECORD.size + size)
+        self._grow(self.end + total)
+        payload = self.end + RECORD.size
+        with memoryview(self.map) as mv, mv[payload:payload + size] as dst:
+            seq, _ = seg.read(dst)
+        RECORD.pack_into(self.map, self.end, now - self.start, seq, index, size)
+        self.end += total
+        self.count += 1
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.hdrsize, self.metalen, self.count, self.end)
+        self.last_seqs[index] = seq
+
+    def poll(self, timeout=None):
+        # Records the frames published since the last poll, waiting up to
+        # timeout for at least one. Returns the number recorded.
+        fds = [seg.fileno() for seg in self.segments]
+        if not any(seg.changed(last) for seg, last in zip(self.segments, self.last_seqs)):
+            select.select(fds, [], [], timeout)
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+        recorded = 0
+        for index, seg in enumerate(self.segments):
+            seg.wait_for_frame(0, self.last_seqs[index])
+            if seg.changed(self.last_seqs[index]):
+                self._append(index, seg, now)
+                recorded += 1
+        return recorded
+
+    def run(self, seconds=None, frames=None):
+        deadline = None if seconds is None else time.perf_counter() + seconds
+        while frames is None or self.count < frames:
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                break
+            self.poll(0.5 if remaining is None else min(remaining, 0.5))
+
+    def close(self):
+        for seg in self.segments:
+            seg.close()
+        self.map.close()
+        self.file.truncate(self.end)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Capture(object):
+    # Read-only access to a capture file: streams is the recorded stream
+    # list, and frames() yields (time, stream index, seq, array) with the
+    # array a view into the file.
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, hdrsize, metalen, self.count, self.end = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError('{} is not a capture file'.format(path))
+        if version != VERSION:
+            raise ValueError('{} has capture version {}, expected {}'.format(path, version, VERSION))
+        self.hdrsize = hdrsize
+        self.streams = json.loads(self.map[STREAMS_OFFSET:STREAMS_OFFSET + metalen].decode('utf8'))
+        self.dtypes = [np.dtype(stream['meta'].get('dtype', 'uint8')) for stream in self.streams]
+        self.shapes = [tuple(stream['meta'].get('shape', (stream['size'],))) for stream in self.streams]
+        self.offsets = np.empty(self.count, dtype=np.int64)
+        self.times = np.empty(self.count, dtype=np.float64)
+        self.indices = np.empty(self.count, dtype=np.uint32)
+        offset = hdrsize
+        for i in range(self.count):
+            t, seq, index, size = RECORD.unpack_from(self.map, offset)
+            self.offsets[i], self.times[i], self.indices[i] = offset, t, index
+            offset += _align(RECORD.size + size)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def duration(self):
+        return float(self.times[-1]) if self.count else 0.0
+
+    def frame(self, i):
+        t, seq, index, size = RECORD.unpack_from(self.map, self.offsets[i])
+        data = np.frombuffer(self.map, dtype=self.dtypes[index], count=size // self.dtypes[index].itemsize, offset=int(self.offsets[i]) + RECORD.size)
+        return t, index, seq, data.reshape(self.shapes[index])
+
+    def frames(self):
+        for i in range(self.count):
+            yield self.frame(i)
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            # Frames are still referenced; the mapping goes with them.
+            pass
+
+class Player(object):
+    # Republishes a capture into procon segments of the same names, layout
+    # and metadata. speed scales the recorded timing; 0 plays as fast as
+    # possible.
+    def __init__(self, path, base=procon.DEFAULT_BASE, prefix=''):
+        self.capture = Capture(path)
+        self.targets = [
+            procon.Segment(prefix + stream['name'], base, stream['size'], stream['meta'], slots=stream['slots'])
+            for stream in self.capture.streams
+        ]
+        self.published = 0
+        self.late = 0
+
+    def play(self, speed=1.0, loop=False):
+        while True:
+            start = time.perf_counter()
+            for t, index, seq, data in self.capture.frames():
+                if speed > 0:
+                    delay = start + t / speed - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif delay < -0.01:
+                        self.late += 1
+                self.targets[index].publish(data)
+                self.published += 1
+            if not loop or not len(self.capture):
+                break
+
+    def close(self):
+        for seg in self.targets:
+            seg.close()
+        self.capture.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Record procon segments to a capture file and replay them.')
+    parser.add_argument('-B', '--base', dest='base', default=procon.DEFAULT_BASE, help='Base path for data files')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    p = sub.add_parser('record', help='Append frames of live segments to a capture file')
+    p.add_argument('output', help='Capture file to write')
+    p.add_argument('names', nargs='+', help='Segments to record')
+    p.add_argument('--seconds', dest='seconds', type=float, help='Stop after this long')
+    p.add_argument('--frames', dest='frames', type=int, help='Stop after this many frames in total')
+    p = sub.add_parser('play', help='Republish a capture file into segments')
+    p.add_argument('input', help='Capture file to play')
+    p.add_argument('--speed', dest='speed', type=float, default=1.0, help='Multiple of the recorded speed (0 is as fast as possible)')
+    p.add_argument('--loop', dest='loop', action='store_true', help='Start over at the end of the capture')
+    p.add_argument('--prefix', dest='prefix', default='', help='Prefix for the republished segment names')
+    p = sub.add_parser('info', help='Describe a capture file')
+    p.add_argument('input', help='Capture file to describe')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        with Recorder(args.output, args.names, args.base) as rec:
+            try:
+                rec.run(args.seconds, args.frames)
+            except KeyboardInterrupt:
+                pass
+            print('Recorded {} frames, {} bytes'.format(rec.count, rec.end))
+    elif args.command == 'play':
+        with Player(args.input, args.base, args.prefix) as player:
+            start = time.perf_counter()
+            try:
+                player.play(args.speed, args.loop)
+            except KeyboardInterrupt:
+                pass
+            elapsed = time.perf_counter() - start
+            print('Published {} frames in {:.2f}s ({} late)'.format(player.published, elapsed, player.late))
+    elif args.command == 'info':
+        cap = Capture(args.input)
+        print('{} frames over {:.2f}s'.format(len(cap), cap.duration))
+        for index, stream in enumerate(cap.streams):
+            count = int(np.count_nonzero(cap.indices == index))
+            print('  {name}: {count} frames of {shape} {dtype}'.format(count=count, **dict(stream, **stream['meta'])))
@@ -1,24 +1,75 @@
-import argparse, sys
+import argparse, os, sys, select, time
 
 import pygame
 
 parser = argparse.ArgumentParser(description='Run a render module.')
+parser.add_argument('--fps', dest='fps', type=float, default=60, help='Maximum frames drawn per second (0 is uncapped)')
+parser.add_argument('--vsync', dest='vsync', action='store_true', help='Synchronize flips with the display refresh, if supported')
 parser.add_argument('module', nargs=argparse.REMAINDER)
 args = parser.parse_args()
 
+# How often window events are checked while waiting for data.
+EVENT_INTERVAL = 0.05
+
 pygame.init()
 W, H = pygame.display.list_modes()[0]
-disp = pygame.display.set_mode((W, H), pygame.FULLSCREEN|pygame.DOUBLEBUF|pygame.HWSURFACE)
+flags = pygame.FULLSCREEN|pygame.DOUBLEBUF|pygame.HWSURFACE
+if args.vsync:
+    # pygame only honours vsync for SCALED (or OPENGL) displays.
+    if hasattr(pygame, 'SCALED'):
+        flags |= pygame.SCALED
+    else:
+        print('vsync needs pygame 2; continuing without it')
+try:
+    disp = pygame.display.set_mode((W, H), flags, vsync=int(args.vsync))
+except (pygame.error, TypeError) as e:
+    print('vsync unavailable ({}); continuing without it'.format(e))
+    disp = pygame.display.set_mode((W, H), flags)
 clock = pygame.time.Clock()
 
 mod = __import__(args.module[0])
 mod.take_args(args.module[1:])
 
+# Modules redraw when one of their input segments publishes a new frame:
+# mod.inputs if given, else mod.data. Modules that animate on their own can
+# define needs_redraw() to ask for frames in between. Modules with no inputs
+# are redrawn continuously, as before. An input that went stale and has been
+# replaced also asks for a redraw, so the module gets to reattach() it; the
+# inputs are looked up again every pass to pick up the new segment.
+def get_inputs():
+    return list(getattr(mod, 'inputs', [mod.data] if hasattr(mod, 'data') else []))
+
+needs_redraw = getattr(mod, 'needs_redraw', lambda: False)
+seen = {}
+dirty = True
+
+def wait(inputs, timeout):
+    # Sleeps until an input publishes, or timeout.
+    if inputs:
+        select.select([seg.fileno() for seg in inputs], [], [], timeout)
+    else:
+        time.sleep(timeout)
+
 while True:
     for ev in pygame.event.get():
         if ev.type == pygame.KEYDOWN and ev.key == pygame.K_q:
             exit()
+        if ev.type in (pygame.VIDEOEXPOSE, pygame.VIDEORESIZE, getattr(pygame, 'WINDOWEXPOSED', pygame.VIDEOEXPOSE)):
+            dirty = True
+    inputs = get_inputs()
+    seen = {seg: seen.get(seg) for seg in inputs}
+    for seg in inputs:
+        if seg.stale:
+            # Redraw once a replacement exists to reattach to.
+            dirty = dirty or os.path.exists(seg.path)
+        elif seg.wait_for_frame(0, seen[seg]):
+            seen[seg] = seg.seq
+            dirty = True
+    if not (dirty or needs_redraw() or not inputs):
+        wait(inputs, EVENT_INTERVAL)
+        continue
+    dirty = False
     disp.fill((0, 0, 0))
     mod.render(disp)
     pygame.display.flip()
-    clock.tick(60)
+    clock.tick(args.fps)
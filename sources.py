@@ -0,0 +1,264 @@
+import time, wave, threading, collections
+
+import numpy as np
+
+class _MissingImport(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        raise ImportError(self.name)
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = _MissingImport('pyaudio')
+
+class Source(object):
+    realtime = True
+    overflows = 0
+
+    def __init__(self, rate, channels):
+        self.rate = rate
+        self.channels = channels
+
+    def read(self, frames):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class PacedSource(Source):
+    # Sources that can produce samples faster than realtime; when realtime is
+    # set, read() sleeps so that samples come out at the nominal rate.
+    def __init__(self, rate, channels, realtime=True):
+        super().__init__(rate, channels)
+        self.realtime = realtime
+        self.produced = 0
+        self.start = None
+
+    def pace(self, frames):
+        if not self.realtime:
+            return
+        if self.start is None:
+            self.start = time.perf_counter()
+        self.produced += frames
+        delay = self.start + self.produced / self.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+class PyAudioSource(Source):
+    def __init__(self, rate, channels=1, device=None):
+        super().__init__(rate, channels)
+        self.pa = pyaudio.PyAudio()
+        self.stream = self.pa.open(
+            rate=rate, channels=channels, format=pyaudio.paFloat32,
+            input=True, input_device_index=device,
+        )
+
+    def read(self, frames):
+        while True:
+            try:
+                data = self.stream.read(frames)
+            except IOError as e:
+                if e.errno != pyaudio.paInputOverflowed:
+                    raise
+                self.overflows += 1
+                continue
+            return np.frombuffer(data, dtype=np.float32).reshape((-1, self.channels))
+
+    def close(self):
+        self.stream.close()
+        self.pa.terminate()
+
+# 24-bit samples are widened into the top bytes of an int32.
+WAV_DTYPES = {1: np.uint8, 2: np.int16, 3: np.int32, 4: np.int32}
+
+class FileSource(PacedSource):
+    # WAV files are decoded with the wave module; anything else is read as
+    # raw interleaved PCM of the given dtype, rate and channel count.
+    def __init__(self, path, rate=44100, channels=1, raw_format='float32', loop=False, realtime=True):
+        self.path = path
+        self.loop = loop
+        self.wav = None
+        if path.lower().endswith('.wav'):
+            self.wav = wave.open(path, 'rb')
+            self.width = width = self.wav.getsampwidth()
+            if width not in WAV_DTYPES:
+                raise ValueError('Unsupported WAV sample width: {} bytes'.format(width))
+            self.dtype = np.dtype(WAV_DTYPES[width])
+            rate, channels = self.wav.getframerate(), self.wav.getnchannels()
+        else:
+            self.file = open(path, 'rb')
+            self.dtype = np.dtype(raw_format)
+        super().__init__(rate, channels, realtime)
+
+    def _read_raw(self, frames):
+        if self.wav is not None:
+            data = self.wav.readframes(frames)
+            if self.width == 3:
+                packed = np.frombuffer(data, dtype=np.uint8).reshape((-1, 3))
+                wide = np.zeros((len(packed), 4), dtype=np.uint8)
+                wide[:, 1:] = packed
+                return wide.view('<i4').ravel()
+            return np.frombuffer(data, dtype=self.dtype)
+        return np.fromfile(self.file, dtype=self.dtype, count=frames * self.channels)
+
+    def _rewind(self):
+        if self.wav is not None:
+            self.wav.rewind()
+        else:
+            self.file.seek(0)
+
+    def read(self, frames):
+        raw = self._read_raw(frames)
+        while self.loop and len(raw) < frames * self.channels:
+            self._rewind()
+            more = self._read_raw(frames - len(raw) // self.channels)
+            if not len(more):
+                # Nothing to loop over.
+                break
+            raw = np.concatenate((raw, more))
+        if self.dtype.kind == 'u':
+            # Offset binary: silence sits at the middle of the range.
+            half = float(2 ** (8 * self.dtype.itemsize - 1))
+            out = (raw.astype(np.float64) - half) / half
+            out = out.astype(np.float32)
+        elif self.dtype.kind == 'i':
+            out = raw.astype(np.float32) / -np.iinfo(self.dtype).min
+        else:
+            out = raw.astype(np.float32, copy=False)
+        out = out[:len(out) - len(out) % self.channels].reshape((-1, self.channels))
+        self.pace(len(out))
+        return out
+
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+        else:
+            self.file.close()
+
+class SynthSource(PacedSource):
+    # spec is a comma-separated list of components, summed:
+    #   sine:FREQ[:AMP]
+    #   chirp:F0:F1:SECONDS[:AMP]  (linear sweep, repeating)
+    #   noise[:AMP]                (white)
+    def __init__(self, spec, rate=44100, channels=1, seed=None, realtime=True):
+        super().__init__(rate, channels, realtime)
+        self.components = [self.parse(part) for part in spec.split(',') if part]
+        self.rng = np.random.RandomState(seed)
+        self.t = 0
+
+    @staticmethod
+    def parse(part):
+        kind, *params = part.split(':')
+        params = [float(p) for p in params]
+        arity = {'sine': 1, 'chirp': 3, 'noise': 0}
+        if kind not in arity or len(params) not in (arity[kind], arity[kind] + 1):
+            raise ValueError('Bad synth component: {}'.format(part))
+        if len(params) == arity[kind]:
+            params.append(1.0 if kind != 'noise' else 0.1)
+        return kind, params
+
+    def read(self, frames):
+        t = (self.t + np.arange(frames)) / self.rate
+        out = np.zeros((frames,), dtype=np.float64)
+        for kind, params in self.components:
+            if kind == 'sine':
+                freq, amp = params
+                out += amp * np.sin(2 * np.pi * freq * t)
+            elif kind == 'chirp':
+                f0, f1, period, amp = params
+                tc = np.mod(t, period)
+                out += amp * np.sin(2 * np.pi * (f0 * tc + (f1 - f0) * tc * tc / (2 * period)))
+            elif kind == 'noise':
+                amp, = params
+                out += amp * self.rng.uniform(-1, 1, frames)
+        self.t += frames
+        self.pace(frames)
+        return np.repeat(out.astype(np.float32)[:, np.newaxis], self.channels, axis=1)
+
+class Capture(threading.Thread):
+    # Reads fixed-size blocks from a source on its own thread and hands them
+    # to the compute stage through a bounded deque as (capture time, block)
+    # pairs. Realtime sources drop the oldest block when the deque is full
+    # (counted in overflows); others block.
+    def __init__(self, source, frames, depth=16, block=None, timer=None):
+        super().__init__(daemon=True)
+        self.timer = timer
+        self.source = source
+        self.frames = frames
+        self.depth = depth
+        self.block = not source.realtime if block is None else block
+        self.queue = collections.deque()
+        self.ready = threading.Event()
+        self.space = threading.Event()
+        self.overflows = 0
+        self.eof = False
+        self.stopped = False
+        self.error = None
+
+    def run(self):
+        try:
+            while not self.stopped:
+                t0 = time.perf_counter()
+                data = self.source.read(self.frames)
+                if self.timer is not None:
+                    self.timer('read', time.perf_counter() - t0)
+                if not len(data):
+                    break
+                if len(data) < self.frames:
+                    data = np.concatenate((data, np.zeros((self.frames - len(data), data.shape[1]), dtype=data.dtype)))
+                while len(self.queue) >= self.depth and not self.stopped:
+                    if not self.block:
+                        try:
+                            self.queue.popleft()
+                        except IndexError:
+                            pass
+                        self.overflows += 1
+                        break
+                    self.space.clear()
+                    if len(self.queue) >= self.depth:
+                        self.space.wait(0.1)
+                self.queue.append((time.perf_counter(), data))
+                self.ready.set()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.eof = True
+            self.ready.set()
+
+    def drain(self, limit=None, timeout=None):
+        blocks = []
+        while True:
+            self.ready.clear()
+            while self.queue and (limit is None or len(blocks) < limit):
+                blocks.append(self.queue.popleft())
+            if blocks or self.eof or self.stopped:
+                break
+            self.ready.wait(timeout)
+        self.space.set()
+        if not blocks and self.error is not None:
+            raise self.error
+        return blocks
+
+    def stop(self, timeout=1.0):
+        # Waits for the thread to finish its current read, so that the source
+        # can be closed safely afterwards. Returns False if it is still busy.
+        self.stopped = True
+        self.space.set()
+        self.ready.set()
+        if self.ident is not None and self is not threading.current_thread():
+            self.join(timeout)
+        return not self.is_alive()
+
+def open_source(kind, rate=44100, channels=1, path=None, raw_format='float32', synth='sine:440', loop=False, seed=None, device=None, realtime=True):
+    if kind == 'pyaudio':
+        return PyAudioSource(rate, channels, device)
+    elif kind == 'file':
+        if path is None:
+            raise ValueError('File source requires an input path')
+        return FileSource(path, rate, channels, raw_format, loop, realtime)
+    elif kind == 'synth':
+        return SynthSource(synth, rate, channels, seed, realtime)
+    raise ValueError('Unknown source: {}'.format(kind))
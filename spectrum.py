@@ -1,6 +1,7 @@
-import math, colorsys, argparse
+import argparse, os
 
 import numpy as np
+import pygame
 
 import procon, util
 
@@ -15,35 +16,148 @@ parser.add_argument('--min-clip', dest='min_clip', type=float, default=-100, hel
 parser.add_argument('--max-clip', dest='max_clip', type=float, default=100, help='Clamped absolute maximum')
 parser.add_argument('--top-val', dest='top_val', type=float, default=0, help='Value represented at the top of the graph')
 parser.add_argument('--range', dest='range', type=float, default=5, help='Range represented vertically in the graph')
+parser.add_argument('--color-levels', dest='color_levels', type=int, default=256, help='Number of intensity steps in the color lookup table')
 args = parser.parse_args([])
 
 def take_args(argv):
     global args
     args = parser.parse_args(argv)
 
-data = procon.get('fft')
+data = procon.attach('fft')
+decibels = data.meta.get('scale') == 'db'
 
-@util.memoized
 def map_x(i):
     return np.log2(i+1)**args.freq_exp
 
-def map_col(i, intensity):
-    return [max(0, min(255, int(255 * cmp))) for cmp in colorsys.hls_to_rgb(0.66 * (i ** args.hue_exp), 0.5 * intensity**args.intensity_exp, 1)]
+@util.table(depends=lambda: args.freq_exp)
+def bin_edges(bins):
+    # map_x at the edges of all bins, from 0 to 1.
+    return map_x(np.arange(bins + 1) / bins)
+
+def map_col(pos, intensity):
+    # Vectorized colorsys.hls_to_rgb(0.66 * pos**hue_exp, 0.5 * intensity**intensity_exp, 1)
+    # as rows of 8-bit RGB. Intensities below zero are never drawn.
+    hue = 0.66 * pos ** args.hue_exp
+    light = 0.5 * np.maximum(intensity, 0) ** args.intensity_exp
+    m2 = np.where(light <= 0.5, light * 2, light + 1 - light)
+    m1 = 2 * light - m2
+    def channel(h):
+        h = h % 1.0
+        return np.select(
+            [h < 1 / 6, h < 0.5, h < 2 / 3],
+            [m1 + (m2 - m1) * h * 6, m2, m1 + (m2 - m1) * (2 / 3 - h) * 6],
+            m1,
+        )
+    rgb = np.stack([channel(hue + 1 / 3), channel(hue), channel(hue - 1 / 3)], axis=-1)
+    return np.clip(255 * rgb, 0, 255).astype(np.uint8)
+
+def map_rgb(surf, rgb):
+    # Vectorized surf.map_rgb for rows of 8-bit RGB.
+    rloss, gloss, bloss, _ = surf.get_losses()
+    rshift, gshift, bshift, _ = surf.get_shifts()
+    rgb = rgb.astype(np.uint32)
+    return ((rgb[:, 0] >> rloss) << rshift) | ((rgb[:, 1] >> gloss) << gshift) | \
+        ((rgb[:, 2] >> bloss) << bshift) | np.uint32(surf.get_masks()[3])
+
+def trunc(a):
+    # Rect coordinates are truncated toward zero, like pygame does.
+    return np.trunc(a).astype(np.intp)
+
+class Layout(object):
+    # Everything about the bars that only depends on the surface and the
+    # arguments: which bins land in each pixel column, the color lookup
+    # table and the scratch arrays for drawing. Rebuilt by layout() when
+    # either changes. Masks are (row, column), matching the memory order of
+    # the surface's pixels.
+    def __init__(self, surf, bins, key):
+        self.key = key
+        w, h = surf.get_size()
+        x = w * bin_edges(bins)
+        start = trunc(x[:-1])
+        end = start + trunc(x[1:] - x[:-1])
+        self.cols = np.arange(w)
+        # Each column shows the maximum of the bins starting in it or, if
+        # there are none, the bar covering it from the left. reduceat over
+        # interleaved (lo, hi) pairs reduces [lo, hi) at the even indices;
+        # hi may be one past the last bin, so values get a spare slot.
+        first = np.searchsorted(start, self.cols, 'left')
+        last = np.searchsorted(start, self.cols, 'right')
+        lo = np.where(last > first, first, np.maximum(last - 1, 0))
+        self.hidden = (last == 0) | ((last == first) & (self.cols >= end[lo]))
+        hi = np.where(self.hidden, lo + 1, np.maximum(last, lo + 1))
+        self.reduce_at = np.stack([lo, hi], axis=1).reshape(-1)
+        self.values = np.empty(bins + 1)
+        # Colors for every column at color_levels intensities, with the hue
+        # of its first bin. Lightness only grows up to white, at an
+        # intensity of 2**(1 / intensity_exp), so that is the top of the
+        # table.
+        self.levels = args.color_levels
+        self.max_intensity = 2 ** (1 / args.intensity_exp) if args.intensity_exp > 0 else 1.0
+        intensity = np.linspace(0, self.max_intensity, self.levels)
+        rgb = map_col((lo / bins)[:, np.newaxis], intensity[np.newaxis, :])
+        self.lut = rgb if surf.get_bytesize() == 3 else map_rgb(surf, rgb.reshape(-1, 3)).reshape(w, self.levels)
+        print('spectrum: {}x{} color table, {:.1f} KiB'.format(w, self.levels, self.lut.nbytes / 1024))
+        self.rows = np.arange(h, dtype=np.int16)[:, np.newaxis]
+        self.mask = np.empty((h, w), dtype=bool)
+        self.below = np.empty((h, w), dtype=bool)
+
+_layout = None
+
+def layout(surf, bins):
+    global _layout
+    key = (surf.get_size(), surf.get_bytesize(), surf.get_masks(), bins, args)
+    if _layout is None or _layout.key != key:
+        _layout = Layout(surf, bins, key)
+    return _layout
+
+raw = np.zeros(data.shape, dtype=data.dtype)
+last_seq = None
+values = None
 
 def render(surf):
+    global data, decibels, raw, last_seq, values
     w, h = surf.get_size()
-    raw = np.frombuffer(data[:], dtype=np.float32)
-    values = np.clip(np.log10(raw), args.min_clip, args.max_clip)
-    for idx, v in enumerate(values):
-        if math.isnan(v):
-            v = args.min_clip
-        frac, fracn = idx / len(values), (idx + 1) / len(values)
-        x, xn = w * map_x(frac), w * map_x(fracn)
-        y = h * (args.top_val - (v / args.range))
-        ny = (h - y) / h
-        col = map_col(frac, ny)
-        if args.y_exp != 1:
-            if ny < 0:
-                continue
-            y = int(h * (1 - ny ** args.y_exp))
-        surf.fill(col, (x, y, xn - x, h - y))
+    if data.stale and os.path.exists(data.path):
+        # The producer restarted with another layout or scale. If the new
+        # file went away again, keep drawing the old frame and retry.
+        try:
+            data = data.reattach()
+        except (FileNotFoundError, ValueError):
+            pass
+        else:
+            decibels = data.meta.get('scale') == 'db'
+            raw = np.zeros(data.shape, dtype=data.dtype)
+            last_seq = values = None
+    if values is None or data.changed(last_seq):
+        last_seq = data.snapshot(raw)
+        if decibels:
+            values = np.clip(raw / 20, args.min_clip, args.max_clip)
+        else:
+            values = np.clip(np.log10(raw), args.min_clip, args.max_clip)
+    lay = layout(surf, len(values))
+    v = lay.values
+    v[:-1] = values
+    v[np.isnan(v)] = args.min_clip
+    v = np.maximum.reduceat(v, lay.reduce_at)[::2]
+    y = h * (args.top_val - (v / args.range))
+    ny = (h - y) / h
+    if args.y_exp != 1:
+        y = np.where(ny < 0, h, trunc(h * (1 - np.maximum(ny, 0) ** args.y_exp)))
+    top = trunc(y)
+    bottom = top + trunc(h - y)
+    top[lay.hidden] = h
+    np.greater_equal(lay.rows, np.clip(top, -1, h).astype(np.int16), out=lay.mask)
+    np.less(lay.rows, np.clip(bottom, -1, h).astype(np.int16), out=lay.below)
+    lay.mask &= lay.below
+    level = np.rint(ny * ((lay.levels - 1) / lay.max_intensity))
+    np.clip(level, 0, lay.levels - 1, out=level)
+    colors = lay.lut[lay.cols, level.astype(np.intp)]
+    # Paints every pixel, so the background is black.
+    if surf.get_bytesize() == 3:
+        pix = pygame.surfarray.pixels3d(surf)
+        np.multiply(lay.mask[..., np.newaxis], colors, out=pix.transpose(1, 0, 2))
+    else:
+        pix = pygame.surfarray.pixels2d(surf)
+        np.multiply(lay.mask, colors, out=pix.T, casting='unsafe')
+    # Unlock the surface.
+    del pix
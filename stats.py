@@ -0,0 +1,102 @@
+import time, json, os
+
+import numpy as np
+
+import dsp
+
+class Timer(object):
+    # Accumulates seconds per stage; one per thread of work so that no
+    # locking is needed, summed up by Stats when reporting.
+    def __init__(self):
+        self.totals = {}
+
+    def __call__(self, stage, seconds):
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+
+class Stats(object):
+    STAGES = ['read', 'buffer', 'window', 'fft', 'publish']
+    FIELDS = ['hops', 'hops_per_sec', 'overflows', 'catchups'] + \
+        ['{}_ms'.format(stage) for stage in STAGES] + \
+        ['latency_p50_ms', 'latency_p90_ms', 'latency_p99_ms']
+
+    def __init__(self, interval=1.0, segment=None, json_path=None, latency_window=1024, watch=()):
+        self.interval = interval
+        self.segment = segment
+        self.json_path = json_path
+        # Published segments whose consumers are reported on.
+        self.watch = list(watch)
+        self.timers = []
+        self.hops = 0
+        self.catchups = 0
+        self.overflows = 0
+        self.latencies = dsp.RingBuffer(latency_window, dtype=np.float64)
+        self.latency_count = 0
+        self.start = self.last = time.perf_counter()
+        self.last_hops = 0
+        self.last_totals = {}
+
+    def timer(self):
+        timer = Timer()
+        self.timers.append(timer)
+        return timer
+
+    def totals(self):
+        totals = dict.fromkeys(self.STAGES, 0.0)
+        for timer in self.timers:
+            for stage, seconds in list(timer.totals.items()):
+                totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+    def record(self, count, captured, now):
+        self.hops += count
+        if count > 1:
+            self.catchups += 1
+        self.latencies.write(now - np.asarray(captured))
+        self.latency_count += len(captured)
+
+    def due(self, now):
+        return self.interval > 0 and now - self.last >= self.interval
+
+    def snapshot(self, now):
+        totals = self.totals()
+        hops = self.hops - self.last_hops
+        snap = {
+            'hops': self.hops,
+            'hops_per_sec': hops / max(now - self.last, 1e-9),
+            'overflows': self.overflows,
+            'catchups': self.catchups,
+        }
+        for stage in self.STAGES:
+            spent = totals[stage] - self.last_totals.get(stage, 0.0)
+            snap['{}_ms'.format(stage)] = 1000 * spent / hops if hops else 0.0
+        lat = self.latencies.latest(min(self.latency_count, self.latencies.size))
+        pcts = np.percentile(lat, (50, 90, 99)) * 1000 if len(lat) else (0.0, 0.0, 0.0)
+        for name, pct in zip(('latency_p50_ms', 'latency_p90_ms', 'latency_p99_ms'), pcts):
+            snap[name] = float(pct)
+        snap['consumers'] = {seg.name: seg.consumers() for seg in self.watch}
+        self.last, self.last_hops, self.last_totals = now, self.hops, totals
+        return snap
+
+    def report(self, now, final=False):
+        snap = self.snapshot(now)
+        if self.segment is not None:
+            self.segment.publish(np.array([snap[field] for field in self.FIELDS], dtype=np.float64))
+        if self.json_path is not None:
+            tmppath = self.json_path + '.tmp'
+            with open(tmppath, 'w') as f:
+                json.dump(snap, f)
+            os.replace(tmppath, self.json_path)
+        line = 'Hops: {hops} ({hops_per_sec:.1f}/s) Overflows: {overflows} Catch-ups: {catchups} ' \
+            'read/buf/win/fft/pub: {read_ms:.2f}/{buffer_ms:.2f}/{window_ms:.2f}/{fft_ms:.2f}/{publish_ms:.2f}ms ' \
+            'Latency p50/p90/p99: {latency_p50_ms:.1f}/{latency_p90_ms:.1f}/{latency_p99_ms:.1f}ms'.format(**snap)
+        for name, readers in snap['consumers'].items():
+            if readers:
+                line += ' {}: {} reader{}, lag<={} skipped {} slowest {:.1f}/s'.format(
+                    name, len(readers), '' if len(readers) == 1 else 's', max(c['lag'] or 0 for c in readers),
+                    sum(c['skipped'] for c in readers), min(c['rate'] for c in readers),
+                )
+        if final:
+            elapsed = now - self.start
+            line = '{} Total: {} hops in {:.1f}s ({:.1f}/s)'.format(line, self.hops, elapsed, self.hops / max(elapsed, 1e-9))
+        print('\r\x1b[K' + line, end='\n' if final else '', flush=True)
+        return snap
@@ -0,0 +1,94 @@
+import tempfile, time
+
+import numpy as np
+
+import procon, bridge
+
+COUNT = 1024
+
+def _wait(receiver, done, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not done():
+        remaining = deadline - time.monotonic()
+        assert remaining > 0, 'timed out waiting for the receiver'
+        receiver.poll(min(remaining, 0.05))
+
+def _expected(encoding, frame):
+    if encoding == 'db8':
+        return 20 * np.log10(frame)
+    return frame
+
+def _check_loopback(proto, encoding, delta):
+    # Frames cross the loopback bridge intact up to the encoding's precision,
+    # and a frame lost in transit is counted, with the deltas after it
+    # skipped until the next keyframe.
+    with tempfile.TemporaryDirectory() as base:
+        prod = procon.create('s', base, shape=(COUNT,))
+        receiver = bridge.Receiver(('127.0.0.1', 0), base, proto, prefix='r.')
+        sender = bridge.Sender(['s'], [receiver.address], base, proto, encoding, delta, keyframe_interval=4)
+        rng = np.random.default_rng(0)
+        # f16 keeps about three significant digits; db8 rounds to a step of
+        # the default 120 dB span.
+        rtol, atol = {'raw': (0, 0), 'f16': (1e-3, 0), 'db8': (0, 60.0 / 255 + 1e-4)}[encoding]
+        try:
+            for i in range(10):
+                frame = rng.uniform(1e-3, 1, COUNT).astype(np.float32)
+                prod.publish(frame)
+                if i == 5:
+                    send, sender._send = sender._send, lambda *a: None
+                    assert sender.poll(0) == 1
+                    sender._send = send
+                    continue
+                received = receiver.received
+                assert sender.poll(0) == 1
+                if i in (6, 7):
+                    # Deltas against the lost frame 5; 8 is a keyframe.
+                    if delta:
+                        _wait(receiver, lambda: receiver.undecodable == i - 5)
+                        continue
+                _wait(receiver, lambda: receiver.received == received + 1)
+                out = procon.attach('r.s', base)
+                assert np.allclose(out.view, _expected(encoding, frame), rtol=rtol, atol=atol)
+                out.close()
+            assert receiver.dropped == 1, receiver.dropped
+            assert receiver.undecodable == (2 if delta else 0), receiver.undecodable
+            assert receiver.late == 0
+        finally:
+            sender.close()
+            receiver.close()
+            prod.close()
+
+def test_loopback():
+    for proto in ('udp', 'tcp'):
+        for encoding in bridge.ENCODINGS:
+            for delta in (False, True):
+                _check_loopback(proto, encoding, delta)
+
+def test_unpublished():
+    # A segment that was never published has no frame to send; the first
+    # real one still arrives as the base of the delta stream.
+    with tempfile.TemporaryDirectory() as base:
+        prod = procon.create('s', base, shape=(COUNT,))
+        receiver = bridge.Receiver(('127.0.0.1', 0), base, 'udp', prefix='r.')
+        sender = bridge.Sender(['s'], [receiver.address], base, 'udp', 'db8', delta=True)
+        try:
+            assert sender.poll(0) == 0
+            _wait(receiver, lambda: receiver.streams)
+            receiver.poll(0.05)
+            assert receiver.received == 0
+            frame = np.full(COUNT, 0.5, dtype=np.float32)
+            prod.publish(frame)
+            assert sender.poll(0) == 1
+            _wait(receiver, lambda: receiver.received == 1)
+            out = procon.attach('r.s', base)
+            assert np.allclose(out.view, _expected('db8', frame), atol=60.0 / 255 + 1e-4)
+            out.close()
+        finally:
+            sender.close()
+            receiver.close()
+            prod.close()
+
+if __name__ == '__main__':
+    test_loopback()
+    test_unpublished()
+    print('ok')
@@ -0,0 +1,24 @@
+import numpy as np
+
+import dsp
+
+def test_sliding_dft_matches_rfft():
+    # The recursive update, without resyncs, stays on the windowed rfft of
+    # the same samples (with the periodic window the sliding DFT applies),
+    # for all bins and for a selection including both edges.
+    window, hop = 256, 16
+    n = np.arange(window)
+    winf = 0.42 - 0.5 * np.cos(2 * np.pi * n / window) + 0.08 * np.cos(4 * np.pi * n / window)
+    for bins in (None, [0, 1, 5, 100, 127, 128]):
+        sdft = dsp.SlidingDFT(window, hop, 'blackman', max_batch=4, bins=bins, resync=0)
+        ring = dsp.RingBuffer(sdft.history)
+        rng = np.random.default_rng(0)
+        for count in (1, 4, 2, 1, 3) * 10:
+            ring.write(rng.standard_normal(count * hop).astype(np.float32))
+            mags = sdft.process(ring, count)
+            expected = (np.abs(np.fft.rfft(ring.latest(window) * winf)) / hop)[sdft.selected]
+            assert np.allclose(mags[-1], expected, rtol=1e-4, atol=1e-4 * expected.max()), np.abs(mags[-1] - expected).max()
+
+if __name__ == '__main__':
+    test_sliding_dft_matches_rfft()
+    print('ok')
@@ -0,0 +1,95 @@
+import asyncio, tempfile, time
+
+import numpy as np
+
+import procon
+
+async def _first_frame(seg, timeout):
+    agen = procon.subscribe(seg)
+    try:
+        return await asyncio.wait_for(agen.__anext__(), timeout)
+    finally:
+        await agen.aclose()
+
+def _check_subscribe_waits(slots):
+    # Subscribing before the first publish must neither spin nor yield the
+    # zeroed payload, and must pick up the first real frame.
+    with tempfile.TemporaryDirectory() as base:
+        prod = procon.create('t', base, shape=(4,), slots=slots)
+        cons = procon.attach('t', base)
+
+        async def main():
+            try:
+                await _first_frame(cons, 0.2)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                raise AssertionError('yielded a frame before anything was published')
+            task = asyncio.ensure_future(_first_frame(cons, 1.0))
+            await asyncio.sleep(0.05)
+            prod.publish(np.arange(4, dtype=np.float32))
+            frame = await task
+            assert frame.seq == 2, frame.seq
+            assert list(frame.data) == [0, 1, 2, 3], frame.data
+
+        asyncio.run(main())
+        cons.close()
+        prod.close()
+
+def test_subscribe_unpublished_unslotted():
+    _check_subscribe_waits(0)
+
+def test_subscribe_unpublished_slotted():
+    _check_subscribe_waits(4)
+
+def test_subscribe_idle_while_consumer_busy():
+    # A consumer that awaits something else between frames must not leave
+    # the event loop spinning on its notification FIFO.
+    with tempfile.TemporaryDirectory() as base:
+        prod = procon.create('t', base, shape=(4,))
+
+        async def produce():
+            frame = 0
+            while True:
+                prod.publish(np.full(4, frame, dtype=np.float32))
+                frame += 1
+                await asyncio.sleep(0.01)
+
+        async def consume():
+            async for frame in procon.subscribe('t', base):
+                await asyncio.sleep(0.25)
+
+        async def main():
+            producer = asyncio.ensure_future(produce())
+            try:
+                await asyncio.wait_for(consume(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                producer.cancel()
+
+        cpu, wall = time.process_time(), time.monotonic()
+        asyncio.run(main())
+        cpu, wall = time.process_time() - cpu, time.monotonic() - wall
+        prod.close()
+        assert cpu < 0.25 * wall, (cpu, wall)
+
+def test_wait_for_frame_unpublished():
+    # Nothing published yet is not a new frame: the wait times out.
+    with tempfile.TemporaryDirectory() as base:
+        prod = procon.create('t', base, shape=(4,))
+        cons = procon.attach('t', base)
+        start = time.monotonic()
+        assert not cons.wait_for_frame(0.2)
+        assert time.monotonic() - start >= 0.2
+        prod.publish(np.arange(4, dtype=np.float32))
+        assert cons.wait_for_frame(0.2)
+        cons.close()
+        prod.close()
+
+if __name__ == '__main__':
+    test_subscribe_unpublished_unslotted()
+    test_subscribe_unpublished_slotted()
+    test_subscribe_idle_while_consumer_busy()
+    test_wait_for_frame_unpublished()
+    print('ok')
@@ -1,9 +1,122 @@
-def memoized(f):
+import threading, collections, functools
+
+# Every cache made here, so they can be inspected or flushed together.
+caches = []
+
+class Cache(object):
+    # A thread-safe LRU mapping, bounded by entry count and optionally by the
+    # total of sizeof(value), with hit/miss/eviction counters.
+    def __init__(self, name=None, maxsize=1024, maxbytes=None, sizeof=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.data = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        caches.append(self)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.data:
+                self._remove(key)
+            self.data[key] = value
+            if self.sizeof is not None:
+                self.bytes += self.sizeof(value)
+            while self.data and ((self.maxsize is not None and len(self.data) > self.maxsize) or
+                                 (self.maxbytes is not None and self.bytes > self.maxbytes and len(self.data) > 1)):
+                self._remove(next(iter(self.data)))
+                self.evictions += 1
+        return value
+
+    def _remove(self, key):
+        value = self.data.pop(key)
+        if self.sizeof is not None:
+            self.bytes -= self.sizeof(value)
+
+    def lookup(self, key, compute):
+        # Returns the cached value for key, computing and storing it on a
+        # miss. compute runs outside the lock, so two threads missing at once
+        # may both compute; the later result wins.
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = self.put(key, compute())
+        return value
+
+    def invalidate(self, predicate=None):
+        # Drops every entry, or those whose key satisfies predicate.
+        with self.lock:
+            for key in [key for key in self.data if predicate is None or predicate(key)]:
+                self._remove(key)
+
+    clear = invalidate
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.data), 'bytes': self.bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            }
+
+def memoized(f=None, maxsize=1024, depends=None, maxbytes=None, sizeof=None):
+    # Caches f by its (hashable) positional arguments. depends, if given, is
+    # called on every lookup and its result becomes part of the key, for
+    # functions that read state other than their arguments:
+    #     @memoized(depends=lambda: args.freq_exp)
+    # The wrapper exposes .cache, .invalidate() and .stats().
+    if f is None:
+        return lambda f: memoized(f, maxsize, depends, maxbytes, sizeof)
+    cache = Cache(getattr(f, '__qualname__', None), maxsize, maxbytes, sizeof)
+    @functools.wraps(f)
     def inner(*args):
-        if args in inner.cache:
-            return inner.cache[args]
-        res = f(*args)
-        inner.cache[args] = res
-        return res
-    inner.cache = {}
+        key = args if depends is None else (depends(), args)
+        return cache.lookup(key, lambda: f(*args))
+    inner.cache = cache
+    inner.invalidate = cache.invalidate
+    inner.stats = cache.stats
     return inner
+
+def _nbytes(value):
+    return getattr(value, 'nbytes', 0)
+
+def _readonly(value):
+    if hasattr(value, 'flags'):
+        value.flags.writeable = False
+    return value
+
+def table(f=None, maxsize=16, depends=None, maxbytes=64 << 20):
+    # Batch mode for array functions: caches the whole table f(*params)
+    # returns per parameter set, instead of one scalar per call, bounded by
+    # the tables' total nbytes. Tables are made read-only since they are
+    # shared between callers.
+    if f is None:
+        return lambda f: table(f, maxsize, depends, maxbytes)
+    inner = memoized(lambda *args: _readonly(f(*args)), maxsize, depends, maxbytes, _nbytes)
+    inner.cache.name = getattr(f, '__qualname__', None)
+    return functools.wraps(f)(inner)
+
+def invalidate_all():
+    for cache in caches:
+        cache.invalidate()
+
+def stats():
+    return {cache.name: cache.stats() for cache in caches}